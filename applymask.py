@@ -1,9 +1,210 @@
 #! /usr/bin/env python3
 
+import os
+import sys
+import glob
+import json
 import math
+import time
+import mmap
+import shutil
 import gzip
+import zlib
+import hashlib
+import warnings
+import queue
 import argparse
+import contextlib
+import threading
+import collections
+import concurrent.futures
 import pathlib
+import multiprocessing
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# mask as sorted, merged, half-open intervals [start, end)
+# memory scales with the number of masked regions, not the genome length
+# length is the genome length, None when it is not known yet
+class Mask:
+    def __init__(self, starts, ends, length=None):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.length = length
+        # masked bases before each interval, built on the first region query
+        self._cumulative = None
+        # (mask file, format) of a range or bed mask loaded without the genome
+        # length, see check_record_mask
+        self.source = None
+
+    # boolean array, True means mask
+    @classmethod
+    def from_array(cls, mask_arr):
+        edges = np.diff(np.concatenate(([0], mask_arr.astype(np.int8), [0])))
+        return cls(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1), len(mask_arr))
+
+    # 0 indexed positions, positions outside the genome are ignored
+    @classmethod
+    def from_positions(cls, positions, length=None):
+        positions = np.asarray(positions, dtype=np.int64)
+        return cls.from_intervals(positions, positions + 1, length)
+
+    # inclusive (begin, end) ranges, possibly unsorted and overlapping
+    @classmethod
+    def from_ranges(cls, ranges, length=None):
+        ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+        return cls.from_intervals(ranges[:, 0], ranges[:, 1] + 1, length)
+
+    # half-open [start, end) intervals, possibly unsorted and overlapping
+    @classmethod
+    def from_intervals(cls, starts, ends, length=None):
+        starts = np.maximum(np.asarray(starts, dtype=np.int64), 0)
+        ends = np.asarray(ends, dtype=np.int64)
+        if length is not None:
+            ends = np.minimum(ends, length)
+        keep = starts < ends
+        starts, ends = starts[keep], ends[keep]
+        if not len(starts):
+            return cls(starts, ends, length)
+        order = np.argsort(starts, kind='stable')
+        starts, ends = starts[order], ends[order]
+        reach = np.maximum.accumulate(ends)
+        new_group = np.concatenate(([True], starts[1:] > reach[:-1]))
+        group_idx = np.flatnonzero(new_group)
+        return cls(starts[group_idx], np.maximum.reduceat(ends, group_idx), length)
+
+    def __contains__(self, position):
+        i = np.searchsorted(self.starts, position, side='right') - 1
+        return bool(i >= 0 and position < self.ends[i])
+
+    def __iter__(self):
+        return zip(self.starts.tolist(), self.ends.tolist())
+
+    # region queries by binary search over the intervals, without expanding
+    # the mask; positions and the half-open [starts, ends) regions may be
+    # scalars or arrays, e.g. the positions of every variant call
+    def is_masked(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        if not len(self.starts):
+            return np.zeros(positions.shape, dtype=bool)
+        i = np.searchsorted(self.starts, positions, side='right') - 1
+        return (i >= 0) & (positions < self.ends[np.maximum(i, 0)])
+
+    # boolean array of the positions [start, end), True means mask
+    # only the intervals overlapping the window are visited
+    def window(self, start, end):
+        first = np.searchsorted(self.ends, start, side='right')
+        last = np.searchsorted(self.starts, end, side='left')
+        delta = np.zeros(end - start + 1, dtype=np.int8)
+        np.add.at(delta, np.maximum(self.starts[first:last], start) - start, 1)
+        np.add.at(delta, np.minimum(self.ends[first:last], end) - start, -1)
+        return np.cumsum(delta[:-1], dtype=np.int8).astype(bool)
+
+    # masked bases within the regions
+    def masked_overlap(self, starts, ends):
+        return np.maximum(self._masked_before(ends) - self._masked_before(starts), 0)
+
+    def overlaps(self, starts, ends):
+        return self.masked_overlap(starts, ends) > 0
+
+    # masked bases before each position
+    def _masked_before(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        if not len(self.starts):
+            return np.zeros(positions.shape, dtype=np.int64)
+        if self._cumulative is None:
+            self._cumulative = np.concatenate(([0], np.cumsum(self.ends - self.starts)))
+        i = np.searchsorted(self.starts, positions, side='left')
+        # the interval before may reach past the position
+        overshoot = np.maximum(self.ends[np.maximum(i - 1, 0)] - positions, 0)
+        return self._cumulative[i] - np.where(i > 0, overshoot, 0)
+
+    def __eq__(self, other):
+        return (isinstance(other, Mask)
+                and np.array_equal(self.starts, other.starts)
+                and np.array_equal(self.ends, other.ends))
+
+    def __repr__(self):
+        return f"Mask({len(self.starts)} intervals, {self.masked_count()} masked bases, length={self.length})"
+
+    # interval algebra, linear in the number of intervals
+    def union(self, other):
+        return self._combine(other, np.logical_or)
+
+    def intersection(self, other):
+        return self._combine(other, np.logical_and)
+
+    def difference(self, other):
+        return self._combine(other, lambda in_self, in_other: in_self & ~in_other)
+
+    def symmetric_difference(self, other):
+        return self._combine(other, np.logical_xor)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+    __xor__ = symmetric_difference
+
+    # sweep over the merged boundaries of both masks, keeping the segments
+    # between consecutive boundaries for which op(in self, in other) holds
+    def _combine(self, other, op):
+        length = self.length if self.length is not None else other.length
+        n_self, n_other = len(self.starts), len(other.starts)
+        positions = np.concatenate((self.starts, self.ends, other.starts, other.ends))
+        if not len(positions):
+            return Mask(positions, positions, length)
+        self_delta = np.zeros(len(positions), dtype=np.int64)
+        self_delta[:n_self] = 1
+        self_delta[n_self:2 * n_self] = -1
+        other_delta = np.zeros(len(positions), dtype=np.int64)
+        other_delta[2 * n_self:2 * n_self + n_other] = 1
+        other_delta[2 * n_self + n_other:] = -1
+        # four sorted runs, which the stable sort merges in linear time
+        order = np.argsort(positions, kind='stable')
+        positions = positions[order]
+        in_self = np.cumsum(self_delta[order]) > 0
+        in_other = np.cumsum(other_delta[order]) > 0
+        # the coverage after the last event at each boundary
+        last = np.concatenate((positions[1:] != positions[:-1], [True]))
+        bounds = positions[last]
+        keep = op(in_self[last], in_other[last])[:-1]
+        return Mask.from_intervals(bounds[:-1][keep], bounds[1:][keep], length)
+
+    def masked_count(self):
+        return int((self.ends - self.starts).sum())
+
+    def clip(self, length):
+        return Mask.from_intervals(self.starts, self.ends, length)
+
+    # genome length boolean array, True means mask
+    def to_array(self, length=None):
+        if length is None:
+            length = self.length if self.length is not None else (int(self.ends[-1]) if len(self.ends) else 0)
+        clipped = self.clip(length)
+        delta = np.zeros(length + 1, dtype=np.int8)
+        delta[clipped.starts] = 1
+        delta[clipped.ends] -= 1
+        return np.cumsum(delta[:-1], dtype=np.int8).astype(bool)
+
+    # fasta mask format string of '0' and '1'
+    def to_string(self, length=None):
+        return np.where(self.to_array(length), b'1', b'0').tobytes().decode()
+
+    def positions(self):
+        lengths = self.ends - self.starts
+        offsets = np.cumsum(lengths) - lengths
+        return np.arange(lengths.sum(), dtype=np.int64) + np.repeat(self.starts - offsets, lengths)
+
+# any mask representation as a Mask
+def as_mask(mask):
+    if isinstance(mask, Mask):
+        return mask
+    return Mask.from_array(mask_to_array(mask))
 
 # fasta format;
 # >header
@@ -14,108 +215,392 @@ def load_mask_fasta(mask_filepath):
     with open(mask_filepath) as f:
         lines = f.readlines()
     mask = "".join([line.strip() for line in lines[1:]])
-    return mask
+    return Mask.from_array(mask_to_array(mask))
+
+# position and range files are parsed in bulk
+# blank lines and '#' comments are skipped, as is a header line of words
+# (begin end, chrom start end) before the data
+# fields are separated by tabs or spaces
+# malformed lines are skipped and reported once, with their line numbers
+
+# returns (labels, values, linenos, malformed)
+#  labels    str array of the leading fields that aren't integers, one row per line
+#  values    int64 array of the last int_columns fields, one row per line
+#  linenos   1 indexed line number of every row
+#  malformed line numbers of the lines that couldn't be parsed
+# columns are the allowed field counts, the first data line picks one of them
+# with extra_columns, fields past the largest count are ignored (bed name, score, ...)
+def parse_mask_table(text, columns, int_columns, extra_columns=False):
+    for width in columns:
+        table = parse_mask_table_fast(text, width, int_columns)
+        if table is not None:
+            return table
+
+    labels, values, linenos, malformed = list(), list(), list(), list()
+    width, header = None, None
+    for lineno, line in enumerate(text.split('\n'), 1):
+        fields = line.split()
+        if not fields or fields[0].startswith('#') or fields[0] in ("track", "browser"):
+            continue
+        if extra_columns:
+            fields = fields[:max(columns)]
+        try:
+            if len(fields) != width and (width is not None or len(fields) not in columns):
+                raise ValueError
+            ints = [int(field) for field in fields[-int_columns:]]
+        except ValueError:
+            if header is None and not linenos and not malformed and all(field.isidentifier() for field in fields):
+                header = line
+            else:
+                malformed.append(lineno)
+            continue
+        width = len(fields)
+        labels.extend(fields[:-int_columns])
+        values.extend(ints)
+        linenos.append(lineno)
+    width = width or columns[0]
+    return (np.array(labels, dtype=str).reshape(len(linenos), width - int_columns),
+            np.array(values, dtype=np.int64).reshape(len(linenos), int_columns),
+            np.array(linenos, dtype=np.int64), malformed)
+
+# whole file at once when every line is data with the same number of fields,
+# None to fall back on parsing line by line
+def parse_mask_table_fast(text, columns, int_columns):
+    text = text.rstrip('\n')
+    if any(token in text for token in ('#', ' ', '\r', '\n\n', '\t\t', '\t\n', '\n\t')) or text[:1] in ('\n', '\t') or text.endswith('\t'):
+        return None
+    # tabs and newlines must alternate as the columns require
+    data = np.frombuffer(text.encode(), dtype=np.uint8)
+    separators = data[(data == ord('\t')) | (data == ord('\n'))]
+    if not ((separators == ord('\n')) == (np.arange(len(separators)) % columns == columns - 1)).all():
+        return None
+    rows = (len(separators) + 1) // columns if text else 0
+    if text and (len(separators) + 1) % columns:
+        return None
+    try:
+        if columns == int_columns:
+            with warnings.catch_warnings():
+                warnings.simplefilter("error")
+                values = np.fromstring(text, dtype=np.int64, sep=' ')
+            labels = np.empty((rows, 0), dtype=str)
+        else:
+            fields = text.split()
+            values = np.array([fields[column::columns] for column in range(columns - int_columns, columns)], dtype=np.int64).T
+            labels = np.array([fields[column::columns] for column in range(columns - int_columns)], dtype=str).T
+    except (ValueError, DeprecationWarning):
+        return None
+    if values.size != rows * int_columns:
+        return None
+    return labels, values.reshape(rows, int_columns), np.arange(1, rows + 1), []
+
+def report_malformed(malformed, description):
+    if malformed:
+        more = f" and {len(malformed) - 10} more" if len(malformed) > 10 else ""
+        print(f"{len(malformed)} malformed {description} lines skipped: line {', '.join(map(str, malformed[:10]))}{more}")
+
+def read_mask_text(mask_filepath):
+    with open(mask_filepath) as f:
+        return f.read()
+
+def lines_to_text(lines):
+    return "\n".join(line.rstrip('\r\n') for line in lines)
 
 # positiion format
 # one position per line
 # 0 index
+# positions outside the genome are ignored
 def load_mask_positon(mask_filepath, length):
-    with open(mask_filepath) as f:
-        lines = f.readlines()
-    return load_mask_position_aux(lines, length)
+    return load_mask_position_text(read_mask_text(mask_filepath), length)
 
 def load_mask_position_aux(lines, length):
-    masked_positions = set()
-    for line in lines:
-        try:
-            masked_positions.add(int(line))
-        except ValueError:
-            print(f"masked position '{line}' is not an integer")
-    mask = list()
-    for i in range(0, length):
-        if i in masked_positions:
-            mask.append('1')
-        else:
-            mask.append('0')
-    return mask
-    
+    return load_mask_position_text(lines_to_text(lines), length)
+
+def load_mask_position_text(text, length):
+    _, values, _, malformed = parse_mask_table(text, (1,), 1)
+    report_malformed(malformed, "masked position")
+    return Mask.from_positions(values[:, 0], length)
+
 # range format
 # tsv range per line
 # 2000 3000 
 # 12000 130000
+# or with a leading chrom column for per contig masks
+# NC_000962_3 2000 3000
+# begin and end are inclusive, ranges with begin > end are malformed and
+# ranges reaching outside the genome raise a ValueError
 def load_mask_range(mask_filepath, length):
-    with open(mask_filepath) as f:
-        lines = f.readlines()
-    return load_mask_range_aux(lines, length)   
+    return load_mask_range_text(read_mask_text(mask_filepath), length)
 
 def load_mask_range_aux(lines, length):
-    masked_ranges = list()
-    for line in lines:
-        try:
-            begin, end = line.strip().split('\t')
-            masked_ranges.append((int(begin), int(end)))
-        except ValueError:
-            print(f"masked range '{line}' couldn't be parsed")
-
-    mask = list()
-    for i in range(0, length):
-        mask.append('0')
-
-    for begin, end in masked_ranges:
-        if begin == end:
-            mask[begin] = '1'
-        else:  
-            for i in range(begin, end+1):
-                mask[i] = '1'
+    return load_mask_range_text(lines_to_text(lines), length)
+
+# returns a Mask, or a dict of Mask keyed by contig name
+# when the ranges have a chrom column
+def load_mask_range_text(text, length):
+    labels, values, linenos, malformed = parse_mask_table(text, (2, 3), 2)
+    reversed_ranges = values[:, 0] > values[:, 1]
+    malformed = sorted(malformed + linenos[reversed_ranges].tolist())
+    labels, values, linenos = labels[~reversed_ranges], values[~reversed_ranges], linenos[~reversed_ranges]
+    report_malformed(malformed, "masked range")
+    check_ranges(values, linenos, length)
+
+    if not labels.shape[1]:
+        return Mask.from_ranges(values, length)
+    return contig_masks(labels[:, 0], values[:, 0], values[:, 1] + 1, length)
+
+# dict of Mask keyed by contig name, in the order the contigs first appear
+def contig_masks(chroms, starts, ends, length=None):
+    names, first, inverse = np.unique(chroms, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    return {str(names[i]): Mask.from_intervals(starts[inverse == i], ends[inverse == i], length) for i in np.argsort(first).tolist()}
+
+# bed format
+# tsv chrom, start and end per line, start 0 indexed and end exclusive
+# NC_000962_3 1999 3000
+# further columns (name, score, strand, ...) and track lines are ignored
+# returns a dict of Mask keyed by contig name
+# index reuses the index of the bed in the mask cache, writing it when it is
+# missing; the bed is parsed as usual when the cache can't be written
+def load_mask_bed(mask_filepath, length=None, index=False, cache_dirpath=None):
+    if not index:
+        return load_mask_bed_text(read_mask_text(mask_filepath), length)
+    cache_dirpath = cache_dirpath or mask_cache_dir()
+    index_filepath = bed_index_filepath(mask_filepath, cache_dirpath)
+    try:
+        mask = load_bed_index(index_filepath, length)
+        # a shared read-only cache is still used
+        with contextlib.suppress(OSError):
+            os.utime(index_filepath)
+        return mask
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    mask = load_mask_bed_text(read_mask_text(mask_filepath), length)
+    try:
+        os.makedirs(cache_dirpath, exist_ok=True)
+        save_bed_index(mask, index_filepath)
+        evict_mask_cache(mask_cache_size(), cache_dirpath)
+    except OSError as e:
+        print(f"bed index not cached: {e}", file=sys.stderr)
+    return mask
+
+def load_mask_bed_text(text, length=None):
+    labels, values, linenos, malformed = parse_mask_table(text, (3,), 2, extra_columns=True)
+    reversed_regions = values[:, 0] > values[:, 1]
+    malformed = sorted(malformed + linenos[reversed_regions].tolist())
+    labels, values, linenos = labels[~reversed_regions], values[~reversed_regions], linenos[~reversed_regions]
+    report_malformed(malformed, "bed")
+    # empty regions, start == end, are allowed and mask nothing
+    check_ranges(np.stack((values[:, 0], np.maximum(values[:, 1] - 1, values[:, 0])), axis=1), linenos, length)
+    return contig_masks(labels[:, 0], values[:, 0], values[:, 1], length)
+
+# keyed by the sha256 of the bed alone, the index holds the unclipped regions
+def bed_index_filepath(mask_filepath, cache_dirpath=None):
+    return os.path.join(cache_dirpath or mask_cache_dir(), file_digest(mask_filepath).hexdigest() + ".npz")
+
+# one starts and one ends array per contig, loaded without parsing the bed
+def save_bed_index(mask, index_filepath):
+    arrays = {"chroms": np.array(list(mask), dtype=str)}
+    for i, contig_mask in enumerate(mask.values()):
+        arrays[f"starts_{i}"] = contig_mask.starts
+        arrays[f"ends_{i}"] = contig_mask.ends
+    with replace_on_success(index_filepath) as tmp_filepath, open(tmp_filepath, "wb") as f:
+        np.savez(f, **arrays)
+
+def load_bed_index(index_filepath, length=None):
+    with np.load(index_filepath) as data:
+        mask = {str(chrom): Mask(data[f"starts_{i}"], data[f"ends_{i}"], length) for i, chrom in enumerate(data["chroms"])}
+    outside = [chrom for chrom, contig_mask in mask.items() if length is not None and len(contig_mask.ends) and contig_mask.ends[-1] > length]
+    if outside:
+        raise ValueError(f"masked regions outside the genome of length {length} on {', '.join(outside)}")
     return mask
 
-# [1,2,3,4,5,7] -> "1-5,7"
+# inclusive ranges must lie within [0, length)
+def check_ranges(ranges, linenos, length):
+    outside = ranges[:, 0] < 0
+    if length is not None:
+        outside |= ranges[:, 1] >= length
+    if outside.any():
+        lines = linenos[outside].tolist()
+        more = f" and {len(lines) - 10} more" if len(lines) > 10 else ""
+        raise ValueError(f"{len(lines)} masked ranges outside the genome of length {length}: line {', '.join(map(str, lines[:10]))}{more}")
+
+# range and bed masks loaded before the record lengths are known remember
+# their file, the file is only parsed again for the line numbers of the
+# ranges outside a record
+def set_mask_source(mask, mask_filepath, mask_format):
+    if mask_format in ("range", "bed"):
+        for contig_mask in (mask.values() if isinstance(mask, dict) else [mask]):
+            if contig_mask.length is None:
+                contig_mask.source = (mask_filepath, mask_format)
+    return mask
+
+# ranges of a range or bed mask must lie within the record they mask
+# raises a ValueError with their line numbers once the record length is known
+def check_record_mask(mask, header, length):
+    for component in (mask.masks if isinstance(mask, MaskComposition) else [mask]):
+        record_mask = mask_for_record(component, header)
+        if record_mask is None or record_mask.source is None or not len(record_mask.ends) or record_mask.ends[-1] <= length:
+            continue
+        mask_filepath, mask_format = record_mask.source
+        check_source_ranges(read_mask_text(mask_filepath), mask_format, record_name(header), length)
+        raise ValueError(f"{mask_filepath} masks {record_name(header)} up to position {record_mask.ends[-1] - 1}, outside its length {length}")
+
+# check_ranges on the ranges of one record of a range or bed file
+def check_source_ranges(text, mask_format, name, length):
+    if mask_format == "bed":
+        labels, values, linenos, _ = parse_mask_table(text, (3,), 2, extra_columns=True)
+        keep = values[:, 0] <= values[:, 1]
+        values = np.stack((values[:, 0], np.maximum(values[:, 1] - 1, values[:, 0])), axis=1)
+    else:
+        labels, values, linenos, _ = parse_mask_table(text, (2, 3), 2)
+        keep = values[:, 0] <= values[:, 1]
+    if labels.shape[1]:
+        keep &= labels[:, 0] == name
+    check_ranges(values[keep], linenos[keep], length)
+
+# contig name from a fasta header, ">NC_000962_3 description" -> "NC_000962_3"
+def record_name(header):
+    fields = header[1:].split()
+    return fields[0] if fields else ""
+
+# the mask for one fasta record, None when the record isn't masked
+# a single Mask applies to every record
+def mask_for_record(mask, header):
+    if isinstance(mask, dict):
+        return mask.get(record_name(header))
+    if isinstance(mask, MaskComposition):
+        return mask.for_record(header)
+    return mask
+
+# several masks combined in interval space, applied in one pass
+# union masks what any mask masks, intersection what every mask masks and
+# difference what the first mask masks and none of the others do
+COMBINE_OPERATIONS = ("union", "intersection", "difference")
+
+def combine_record_masks(record_masks, operation="union"):
+    if operation == "union":
+        record_masks = [record_mask for record_mask in record_masks if record_mask is not None]
+    elif operation == "intersection":
+        if any(record_mask is None for record_mask in record_masks):
+            return None
+    elif operation == "difference":
+        if record_masks[0] is None:
+            return None
+        record_masks = [record_masks[0]] + [record_mask for record_mask in record_masks[1:] if record_mask is not None]
+    else:
+        raise ValueError(f"unknown operation: {operation}, expected one of: {', '.join(COMBINE_OPERATIONS)}")
+    if not record_masks:
+        return None
+    combined = record_masks[0]
+    for record_mask in record_masks[1:]:
+        combined = getattr(combined, operation)(record_mask)
+    return combined
+
+# composition of per contig masks with other masks, resolved per record
+class MaskComposition:
+    def __init__(self, masks, operation="union"):
+        self.masks = masks
+        self.operation = operation
+        self.record_masks = dict()
+
+    def for_record(self, header):
+        name = record_name(header)
+        if name not in self.record_masks:
+            self.record_masks[name] = combine_record_masks([mask_for_record(mask, header) for mask in self.masks], self.operation)
+        return self.record_masks[name]
+
+# a single Mask when none of the masks is per contig or still to be checked
+# against the records, see check_record_mask
+def compose_masks(masks, operation="union"):
+    if operation not in COMBINE_OPERATIONS:
+        raise ValueError(f"unknown operation: {operation}, expected one of: {', '.join(COMBINE_OPERATIONS)}")
+    if len(masks) == 1:
+        return masks[0]
+    if all(isinstance(mask, Mask) and mask.source is None for mask in masks):
+        return combine_record_masks(masks, operation)
+    return MaskComposition(masks, operation)
+
+# per mask (masked bases, changed bases) over the records [(header, length)]
+# changed bases are those the composed mask would lose or gain without that
+# mask, all the bases of the result for the first mask of a difference
+def mask_contributions(masks, records, operation="union"):
+    contributions = [[0, 0] for _ in masks]
+    for header, length in records:
+        empty = Mask([], [], length)
+        record_masks = [mask_for_record(mask, header) for mask in masks]
+        record_masks = [None if record_mask is None else record_mask.clip(length) for record_mask in record_masks]
+        combined = combine_record_masks(record_masks, operation) or empty
+        for i, record_mask in enumerate(record_masks):
+            if record_mask is None:
+                continue
+            contributions[i][0] += record_mask.masked_count()
+            if operation == "difference" and i == 0:
+                contributions[i][1] += combined.masked_count()
+                continue
+            without = combine_record_masks(record_masks[:i] + record_masks[i + 1:], operation) or empty
+            contributions[i][1] += (combined ^ without).masked_count()
+    return [tuple(contribution) for contribution in contributions]
+
+# [1,2,3,4,5,7] -> [(1,5),(7,7)]
+# sorted positions to inclusive ranges
 def lst_to_range_str(lst):
-    ret = list()
-    start = None
-    end = None
-    for elem in lst:
-        if start is None:
-            start = elem
-            end = elem
-        if elem == end or elem == end + 1:
-            end = elem
-        else:
-            if start == end:
-                ret.append((start, start))
-            else:
-                ret.append((start, end))
-            start = elem
-            end = elem
-    if start:
-        if start == end:
-            ret.append((start, start))
-    return ret
+    starts, ends = inclusive_ranges(Mask.from_positions(lst))
+    return list(zip(starts.tolist(), ends.tolist()))
+
+# inclusive (begins, ends) arrays of the masked runs
+# from a Mask, or edge detection on any fasta mask representation
+def inclusive_ranges(fasta_mask):
+    mask = as_mask(fasta_mask)
+    return mask.starts, mask.ends - 1
 
+# range format, begin and end inclusive
 def get_mask_ranges(fasta_mask):
-    mask_lst = list()
-    for i, x in enumerate(fasta_mask):
-        if x == '1':
-            mask_lst.append(i)
-    mask_str = lst_to_range_str(mask_lst)
-    mask_ranges = [f"{x}\t{y}" for (x, y) in mask_str]
-    return "\n".join(mask_ranges)
+    begins, ends = inclusive_ranges(fasta_mask)
+    return "\n".join(map("{}\t{}".format, begins.tolist(), ends.tolist()))
 
+# bed format, start inclusive and end exclusive
+def get_mask_bed(fasta_mask, chrom):
+    mask = as_mask(fasta_mask)
+    return "\n".join(f"{chrom}\t{start}\t{end}" for start, end in zip(mask.starts.tolist(), mask.ends.tolist()))
+
+# yields (header, sequence, chunk_len) one record at a time
+def iter_fasta_records(lines):
+    header, seq_lines = None, list()
+    for line in lines:
+        line = line.strip()
+        if line.startswith('>'):
+            if header is not None:
+                yield header, "".join(seq_lines), len(seq_lines[0]) if seq_lines else 0
+            header, seq_lines = line, list()
+        elif header is not None:
+            seq_lines.append(line)
+    if header is not None:
+        yield header, "".join(seq_lines), len(seq_lines[0]) if seq_lines else 0
+
+# [(header, sequence, chunk_len), ...] one tuple per record
+def parse_fasta_records(lines):
+    return list(iter_fasta_records(lines))
+
+# only one record is held in memory at a time
+def read_fasta_records(fasta_filepath, use_gzip=False):
+    with open_fasta(fasta_filepath, "rt", use_gzip) as f:
+        yield from iter_fasta_records(f)
+
+def load_fasta_records(fasta_filepath, use_gzip=False):
+    if use_gzip:
+        with gzip.open(fasta_filepath, "rb") as f:
+            lines = f.read().decode().split('\n')
+    else:
+        with open(fasta_filepath) as f:
+            lines = f.readlines()
+    return parse_fasta_records(lines)
+
+# first record only, see load_fasta_records for multi-record files
 def load_fasta(fasta_filepath):
-    with open(fasta_filepath) as f:
-        lines = f.readlines()
-    header = lines[0].strip()
-    chunk_len = len(lines[1]) - 1 #remove the new line
-    sequence = "".join([line.strip() for line in lines[1:]])
-    return (header, sequence, chunk_len)
+    return load_fasta_records(fasta_filepath)[0]
 
 def load_fasta_gzip(fasta_filepath):
-    with gzip.open(fasta_filepath, "rb") as f:
-        lines = f.read().decode().split('\n')
-    header = lines[0].strip()
-    chunk_len = len(lines[1]) # no new line in gzip
-    sequence = "".join([line.strip() for line in lines[1:]])
-    return (header, sequence, chunk_len)
+    return load_fasta_records(fasta_filepath, True)[0]
 
 def string_insert_newlines(in_str, chunk_len):
     ret = list()
@@ -125,72 +610,978 @@ def string_insert_newlines(in_str, chunk_len):
     new_str = "\n".join(ret)
     return new_str
 
+# bases copied per write by write_wrapped
+WRAP_BATCH = 1 << 20
+
+# write sequence to the binary stream f wrapped at chunk_len, without a
+# trailing newline, the same bytes as string_insert_newlines
+# sequence is a str, any bytes-like object or a uint8 array; a batch of whole
+# lines at a time is copied between the fixed newlines of one reused buffer,
+# so no full size copy of the sequence is made
+def write_wrapped(f, sequence, chunk_len, batch_size=WRAP_BATCH):
+    if not isinstance(sequence, (str, np.ndarray)):
+        sequence = np.frombuffer(sequence, dtype=np.uint8)
+    length = len(sequence)
+    chunk_len = chunk_len or length or 1
+    lines_per_batch = max(1, batch_size // chunk_len)
+    lines = np.full((min(lines_per_batch, -(-length // chunk_len)), chunk_len + 1), ord('\n'), dtype=np.uint8)
+    flat = lines.reshape(-1)
+    for start in range(0, length, lines_per_batch * chunk_len):
+        batch = sequence[start:start + lines_per_batch * chunk_len]
+        if isinstance(batch, str):
+            batch = np.frombuffer(batch.encode(), dtype=np.uint8)
+        full, rest = divmod(len(batch), chunk_len)
+        lines[:full, :chunk_len] = batch[:full * chunk_len].reshape(full, chunk_len)
+        if rest:
+            lines[full, :rest] = batch[full * chunk_len:]
+        size = full * (chunk_len + 1) + rest
+        # the last line has no newline
+        if start + len(batch) == length and not rest:
+            size -= 1
+        f.write(flat[:size].data)
+
 def save_fasta(fasta_filepath, header, sequence, chunk_len):
-    with open(fasta_filepath, "w") as f:
-        f.write(header + '\n')
-        f.write(string_insert_newlines(sequence, chunk_len))
+    with open(fasta_filepath, "wb") as f:
+        f.write((header + '\n').encode())
+        write_wrapped(f, sequence, chunk_len)
         print(f'file {fasta_filepath} created.')
 
-def save_fasta_gzip(fasta_filepath, header, sequence, chunk_len):
-    with gzip.open(fasta_filepath, "wb") as f:
-        f.write(bytearray(header + '\n', 'utf-8'))
-        f.write(bytearray(string_insert_newlines(sequence, chunk_len), 'utf-8'))
+def save_fasta_gzip(fasta_filepath, header, sequence, chunk_len, compresslevel=9, threads=1):
+    with open_fasta(fasta_filepath, "wb", True, compresslevel, threads) as f:
+        f.write((header + '\n').encode())
+        write_wrapped(f, sequence, chunk_len)
         print(f'file {fasta_filepath} created.')
 
+def save_fasta_records(fasta_filepath, records, use_gzip=False, compresslevel=9, threads=1):
+    with open_fasta(fasta_filepath, "wb", use_gzip, compresslevel, threads) as f:
+        for i, (header, sequence, chunk_len) in enumerate(records):
+            f.write((("\n" if i else "") + header + '\n').encode())
+            write_wrapped(f, sequence, chunk_len)
+    print(f'file {fasta_filepath} created.')
+
+# mask as a boolean numpy array, True means mask
+# accepts a Mask, the fasta mask string, a list of '0'/'1' or an array
+def mask_to_array(mask):
+    if isinstance(mask, Mask):
+        return mask.to_array()
+    if isinstance(mask, np.ndarray):
+        return mask.astype(bool, copy=False)
+    if not isinstance(mask, str):
+        mask = "".join(mask)
+    return np.frombuffer(mask.encode(), dtype=np.uint8) == ord('1')
+
+# sequence as a writable uint8 numpy array
+def sequence_to_array(sequence):
+    if not isinstance(sequence, str):
+        sequence = "".join(sequence)
+    return np.frombuffer(sequence.encode(), dtype=np.uint8).copy()
+
 def apply_mask(mask, sequence):
-    new_sequence = list()
-    for i, _ in enumerate(sequence):
-        if mask[i] == '1':
-            new_sequence.append('N')
-        else:
-            new_sequence.append(sequence[i])
-    new_sequence_str = "".join(new_sequence)
-    return new_sequence_str
+    seq_arr = sequence_to_array(sequence)
+    if isinstance(mask, Mask) and mask.length is None:
+        mask = mask.clip(len(seq_arr))
+    mask_arr = mask_to_array(mask)
+    if len(mask_arr) < len(seq_arr):
+        raise IndexError(f"mask length {len(mask_arr)} is shorter than sequence length {len(seq_arr)}")
+    seq_arr[mask_arr[:len(seq_arr)]] = ord('N')
+    return seq_arr.tobytes().decode()
 
-def arg_is_true(arg):
-    return arg in ["true", "yes", "oui"]
+# one complete gzip member holding block
+def gzip_member(block, compresslevel):
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+# gzip writer compressing fixed size blocks on a thread pool
+# the output is a series of concatenated gzip members, readable by gzip, zcat
+# and the gzip module; zlib releases the GIL so blocks compress in parallel
+class ParallelGzipWriter:
+    def __init__(self, fasta_filepath, compresslevel=9, threads=None, block_size=1 << 20):
+        self.compresslevel = compresslevel
+        self.threads = threads or available_cores()
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.threads)
+        self.f = open(fasta_filepath, "wb")
+
+    def __enter__(self):
+        return self
 
-def main(mask_filepath, mask_format, fasta_filepath, use_gzip, print_mask_ranges):
-    
-    #Load mask file, transform to fasta format
-    if arg_is_true(use_gzip):
-        (fasta_header, fasta_sequence, fasta_chunk_len) = load_fasta_gzip(fasta_filepath)
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _submit(self, block):
+        self.pending.append(self.pool.submit(gzip_member, block, self.compresslevel))
+        # keep a bounded number of blocks in flight, written in order
+        while len(self.pending) > 2 * self.threads:
+            self.f.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.f.closed:
+            return
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self.f.write(self.pending.popleft().result())
+        finally:
+            self.pool.shutdown()
+            self.f.close()
+
+# yields a temporary path next to filepath that is moved to filepath only when
+# the block succeeds, a failure never leaves a partial file under the real name
+@contextlib.contextmanager
+def replace_on_success(filepath):
+    tmp_filepath = f"{filepath}.{os.getpid()}.tmp"
+    try:
+        yield tmp_filepath
+    except BaseException:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+        raise
+    os.replace(tmp_filepath, filepath)
+
+# compresslevel and threads only apply to gzip output
+# threads > 1 compresses blocks in parallel with ParallelGzipWriter
+def open_fasta(fasta_filepath, mode, use_gzip, compresslevel=9, threads=1):
+    if use_gzip:
+        if 'w' in mode and threads != 1:
+            return ParallelGzipWriter(fasta_filepath, compresslevel, threads)
+        return gzip.open(fasta_filepath, mode, compresslevel)
+    return open(fasta_filepath, mode)
+
+# mask one wrapped sequence line, offset is the position of its first base
+# only the intervals overlapping the line are visited
+def mask_line(mask, line, offset):
+    line_len = len(line.rstrip(b'\r\n'))
+    if mask.length is not None and offset + line_len > mask.length:
+        raise IndexError(f"mask length {mask.length} is shorter than sequence length {offset + line_len}")
+    first = np.searchsorted(mask.ends, offset, side='right')
+    last = np.searchsorted(mask.starts, offset + line_len, side='left')
+    if first >= last:
+        return line
+    new_line = bytearray(line)
+    for start, end in zip(mask.starts[first:last].tolist(), mask.ends[first:last].tolist()):
+        start = max(start, offset) - offset
+        end = min(end, offset + line_len) - offset
+        new_line[start:end] = b'N' * (end - start)
+    return new_line
+
+# masks the lines of a fasta in order, possibly spread over several calls
+# records holds [header, sequence length] for the records seen so far
+class FastaLineMasker:
+    def __init__(self, mask):
+        self.mask = mask
+        self.record_mask = None
+        self.records = list()
+
+    def mask_line(self, line):
+        if line.startswith(b'>'):
+            self.check_record()
+            header = line.decode().strip()
+            self.records.append([header, 0])
+            self.record_mask = mask_for_record(self.mask, header)
+        elif self.records:
+            offset = self.records[-1][1]
+            self.records[-1][1] += len(line.rstrip(b'\r\n'))
+            if self.record_mask is not None:
+                return mask_line(self.record_mask, line, offset)
+        return line
+
+    def mask_lines(self, lines):
+        return [self.mask_line(line) for line in lines]
+
+    # at the end of each record, once its length is known, see check_record_mask
+    def check_record(self):
+        if self.records:
+            check_record_mask(self.mask, *self.records[-1])
+
+    # [(header, sequence length), ...] one tuple per record
+    def record_lengths(self):
+        return [tuple(record) for record in self.records]
+
+# read, mask and write one line at a time, keeping the original wrapping
+# peak memory does not depend on the size of the fasta
+# the output only appears under new_fasta_filepath once complete
+# records without a mask are copied through unchanged
+# returns [(header, sequence length), ...] one tuple per record
+def mask_fasta_stream(mask, fasta_filepath, new_fasta_filepath, use_gzip, compresslevel=9, threads=1):
+    masker = FastaLineMasker(mask)
+    with replace_on_success(new_fasta_filepath) as tmp_filepath:
+        with open_fasta(fasta_filepath, "rb", use_gzip) as f_in, open_fasta(tmp_filepath, "wb", use_gzip, compresslevel, threads) as f_out:
+            for line in f_in:
+                f_out.write(masker.mask_line(line))
+            masker.check_record()
+    print(f'file {new_fasta_filepath} created.')
+    return masker.record_lengths()
+
+# queue helpers giving up once another pipeline stage has failed
+# _pipeline_put returns False then, _pipeline_get None
+def _pipeline_put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _pipeline_get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+# like mask_fasta_stream, with decompression, masking and compression running
+# concurrently on their own threads, connected by queues of chunks of lines
+# memory is bounded by queue_depth chunks of about chunk_size bytes per queue
+def mask_fasta_pipeline(mask, fasta_filepath, new_fasta_filepath, use_gzip, compresslevel=9, threads=1, queue_depth=8, chunk_size=1 << 20):
+    read_q = queue.Queue(queue_depth)
+    write_q = queue.Queue(queue_depth)
+    stop = threading.Event()
+    masker = FastaLineMasker(mask)
+
+    def read_chunks():
+        with open_fasta(fasta_filepath, "rb", use_gzip) as f_in:
+            for lines in iter(lambda: f_in.readlines(chunk_size), []):
+                if not _pipeline_put(read_q, lines, stop):
+                    return
+        _pipeline_put(read_q, None, stop)
+
+    def mask_chunks():
+        for lines in iter(lambda: _pipeline_get(read_q, stop), None):
+            if not _pipeline_put(write_q, b"".join(masker.mask_lines(lines)), stop):
+                return
+        if stop.is_set():
+            return
+        masker.check_record()
+        _pipeline_put(write_q, None, stop)
+
+    def write_chunks(tmp_filepath):
+        with open_fasta(tmp_filepath, "wb", use_gzip, compresslevel, threads) as f_out:
+            for chunk in iter(lambda: _pipeline_get(write_q, stop), None):
+                f_out.write(chunk)
+
+    with replace_on_success(new_fasta_filepath) as tmp_filepath, concurrent.futures.ThreadPoolExecutor(3) as pool:
+        stages = [pool.submit(read_chunks), pool.submit(mask_chunks), pool.submit(write_chunks, tmp_filepath)]
+        for stage in concurrent.futures.as_completed(stages):
+            if stage.exception() is not None:
+                stop.set()
+        for stage in stages:
+            stage.result()
+    print(f'file {new_fasta_filepath} created.')
+    return masker.record_lengths()
+
+# byte layout of an uncompressed single record fasta wrapped at a fixed width
+# returns (header, sequence start offset, line width, newline length, sequence length)
+def fasta_layout(mm):
+    seq_start = mm.find(b'\n') + 1
+    if seq_start == 0:
+        raise ValueError("fasta has no sequence")
+    if mm.find(b'\n>') != -1:
+        raise ValueError("fasta has more than one record")
+    header = mm[:seq_start].decode().strip()
+    line_end = mm.find(b'\n', seq_start)
+    if line_end == -1:
+        return header, seq_start, len(mm) - seq_start, 1, len(mm) - seq_start
+    newline_len = 2 if mm[line_end - 1:line_end] == b'\r' else 1
+    width = line_end + 1 - newline_len - seq_start
+    if width <= 0:
+        raise ValueError("fasta has an empty sequence line")
+    full_lines, rest = divmod(len(mm) - seq_start, width + newline_len)
+    if rest and mm[len(mm) - 1:] == b'\n':
+        rest -= newline_len
+    return header, seq_start, width, newline_len, full_lines * width + rest
+
+# write 'N' only at the byte offsets of the masked bases of an uncompressed fasta
+# the file is patched in place through a memory map, or when new_fasta_filepath
+# is given a copy of the input is patched and only then moved to it
+# cost is proportional to the number of masked bases, not the genome size
+# returns [(header, sequence length)]
+def patch_fasta_inplace(mask, fasta_filepath, new_fasta_filepath=None):
+    if new_fasta_filepath is None or new_fasta_filepath == fasta_filepath:
+        records = patch_fasta_mmap(mask, fasta_filepath)
     else:
-        (fasta_header, fasta_sequence, fasta_chunk_len) = load_fasta(fasta_filepath)
+        with replace_on_success(new_fasta_filepath) as tmp_filepath:
+            shutil.copyfile(fasta_filepath, tmp_filepath)
+            records = patch_fasta_mmap(mask, tmp_filepath, fasta_filepath)
+    print(f'file {new_fasta_filepath or fasta_filepath} patched.')
+    return records
+
+# the layout and every touched line are checked before any byte is written
+# errors name display_filepath, the input when fasta_filepath is a copy of it
+def patch_fasta_mmap(mask, fasta_filepath, display_filepath=None):
+    with open(fasta_filepath, "r+b") as f, mmap.mmap(f.fileno(), 0) as mm:
+        header, seq_start, width, newline_len, seq_len = fasta_layout(mm)
+        check_record_mask(mask, header, seq_len)
+        record_mask = mask_for_record(mask, header)
+        if record_mask is None:
+            return [(header, seq_len)]
+        if record_mask.length is not None and record_mask.length < seq_len:
+            raise IndexError(f"mask length {record_mask.length} is shorter than sequence length {seq_len}")
 
+        buf = np.frombuffer(mm, dtype=np.uint8)
+        try:
+            buf[sequence_offsets(buf, (seq_start, width, newline_len), record_mask.clip(seq_len).positions(), display_filepath or fasta_filepath)] = ord('N')
+        finally:
+            del buf
+    return [(header, seq_len)]
+
+# byte offsets of sequence positions in a fasta with the fasta_layout
+# (sequence start offset, line width, newline length)
+# every touched line must end where a fixed width layout says it does
+def sequence_offsets(buf, layout, positions, fasta_filepath):
+    seq_start, width, newline_len = layout
+    lines, columns = np.divmod(positions, width)
+    line_ends = seq_start + np.unique(lines) * (width + newline_len) + width
+    line_ends = buf[line_ends[line_ends < len(buf)]]
+    # no reference to the buffer may outlive an error, the caller's memory map
+    # can't be closed while the traceback holds one
+    del buf
+    if not np.all(line_ends == ord('\r' if newline_len == 2 else '\n')):
+        raise ValueError(f"{fasta_filepath} is not a single record fasta wrapped at {width} bases")
+    return seq_start + lines * (width + newline_len) + columns
+
+# incremental re-masking
+# a fasta masked with previous_mask is moved to mask by rewriting only the
+# delta: bases masked by mask alone become N, bases masked by previous_mask
+# alone are restored from the unmasked source fasta
+# returns (to_mask, to_restore) as Mask for one record
+def record_mask_delta(previous_mask, mask, header, seq_len):
+    empty = Mask([], [], seq_len)
+    previous_mask = (mask_for_record(previous_mask, header) or empty).clip(seq_len)
+    mask = (mask_for_record(mask, header) or empty).clip(seq_len)
+    return mask - previous_mask, previous_mask - mask
+
+# uncompressed fasta without a second header
+def single_record_fasta(fasta_filepath):
+    with open(fasta_filepath, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return mm.find(b'\n>') == -1
+
+# the fasta is rewritten in place, patched through a memory map when both
+# it and the source are uncompressed single record fastas
+# returns [(header, bases masked, bases restored)]
+def remask_fasta(previous_mask, mask, fasta_filepath, source_filepath, use_gzip=False):
+    source_gzip = source_filepath.endswith(".gz")
+    if not use_gzip and not source_gzip and single_record_fasta(fasta_filepath) and single_record_fasta(source_filepath):
+        return remask_fasta_inplace(previous_mask, mask, fasta_filepath, source_filepath)
+
+    sources = {record_name(header): sequence for header, sequence, _ in load_fasta_records(source_filepath, source_gzip)}
+    new_records, changes = list(), list()
+    for header, sequence, chunk_len in load_fasta_records(fasta_filepath, use_gzip):
+        check_record_mask(mask, header, len(sequence))
+        to_mask, to_restore = record_mask_delta(previous_mask, mask, header, len(sequence))
+        if to_mask.masked_count() or to_restore.masked_count():
+            source = sources.get(record_name(header))
+            if source is None or len(source) != len(sequence):
+                raise ValueError(f"{source_filepath} has no record {record_name(header)} of length {len(sequence)}")
+            buf = sequence_to_array(sequence)
+            restore_positions = to_restore.positions()
+            check_previously_masked(buf[restore_positions], fasta_filepath, header)
+            buf[restore_positions] = sequence_to_array(source)[restore_positions]
+            buf[to_mask.positions()] = ord('N')
+            sequence = buf.tobytes().decode()
+        new_records.append((header, sequence, chunk_len))
+        changes.append((header, to_mask.masked_count(), to_restore.masked_count()))
+    with replace_on_success(fasta_filepath) as tmp_filepath:
+        save_fasta_records(tmp_filepath, new_records, use_gzip)
+    return changes
+
+def remask_fasta_inplace(previous_mask, mask, fasta_filepath, source_filepath):
+    with open(fasta_filepath, "r+b") as f, mmap.mmap(f.fileno(), 0) as mm, \
+         open(source_filepath, "rb") as source_f, mmap.mmap(source_f.fileno(), 0, access=mmap.ACCESS_READ) as source_mm:
+        header, seq_start, width, newline_len, seq_len = fasta_layout(mm)
+        _, source_start, source_width, source_newline_len, source_len = fasta_layout(source_mm)
+        if source_len != seq_len:
+            raise ValueError(f"{source_filepath} has length {source_len}, expected {seq_len}")
+        check_record_mask(mask, header, seq_len)
+        to_mask, to_restore = record_mask_delta(previous_mask, mask, header, seq_len)
+
+        buf = np.frombuffer(mm, dtype=np.uint8)
+        source_buf = np.frombuffer(source_mm, dtype=np.uint8)
+        try:
+            # every offset is checked before the first byte is written
+            restore_positions = to_restore.positions()
+            offsets = sequence_offsets(buf, (seq_start, width, newline_len), restore_positions, fasta_filepath)
+            source_offsets = sequence_offsets(source_buf, (source_start, source_width, source_newline_len), restore_positions, source_filepath)
+            mask_offsets = sequence_offsets(buf, (seq_start, width, newline_len), to_mask.positions(), fasta_filepath)
+            check_previously_masked(buf[offsets], fasta_filepath, header)
+            buf[offsets] = source_buf[source_offsets]
+            buf[mask_offsets] = ord('N')
+        finally:
+            del buf, source_buf
+    return [(header, to_mask.masked_count(), to_restore.masked_count())]
+
+# the bases to restore must all be N, or the fasta wasn't masked with the
+# previous mask
+def check_previously_masked(bases, fasta_filepath, header):
+    unmasked = np.count_nonzero(bases != ord('N'))
+    if unmasked:
+        raise ValueError(f"{fasta_filepath} {header} has {unmasked} unmasked bases where the previous mask masks")
+
+def arg_is_true(arg):
+    return arg in ["true", "yes", "oui"]
+
+def load_mask(mask_filepath, mask_format, length=None):
     if mask_format == "fasta":
-        mask = load_mask_fasta(mask_filepath)
+        return load_mask_fasta(mask_filepath)
+    elif mask_format == "position":
+        return load_mask_positon(mask_filepath, length)
+    elif mask_format == "range":
+        return set_mask_source(load_mask_range(mask_filepath, length), mask_filepath, mask_format)
+    elif mask_format == "bed":
+        return set_mask_source(load_mask_bed(mask_filepath, length), mask_filepath, mask_format)
+    print(f"unknown mask format: {mask_format}")
+    print("expected one of: fasta, position, range, bed")
+    return None
+
+# write a Mask in fasta, position, range or bed format
+# bed also takes a dict of Mask keyed by contig name, a single Mask is written
+# for the contig chrom
+def save_mask(mask, mask_filepath, mask_format, length=None, chrom=None):
+    if mask_format == "bed":
+        if not isinstance(mask, dict):
+            if chrom is None:
+                raise ValueError("the bed format needs the chrom of the mask")
+            mask = {chrom: mask}
+        text = "\n".join(get_mask_bed(contig_mask, contig) for contig, contig_mask in mask.items() if len(contig_mask.starts))
+    elif mask_format == "fasta":
+        text = ">mask\n" + string_insert_newlines(mask.to_string(length), 60)
     elif mask_format == "position":
-        mask = load_mask_positon(mask_filepath, len(fasta_sequence))
+        text = "\n".join(map(str, mask.positions().tolist()))
     elif mask_format == "range":
-        mask = load_mask_range(mask_filepath, len(fasta_sequence))
+        text = get_mask_ranges(mask)
     else:
-        print(f"unknown mask format: {mask_format}")
-        print("expected one of: fasta, position, range")
-        return
+        raise ValueError(f"unknown mask format: {mask_format}, expected one of: fasta, position, range, bed")
+    with open(mask_filepath, "w") as f:
+        f.write(text)
+    print(f'file {mask_filepath} created.')
+
+# compiled mask cache
+# one .npy file per mask holding int64 [length, start, end, start, end, ...]
+# keyed by the sha256 of the mask file, the mask format and the genome length
+# bed masks are cached as one .npz index per bed, see load_mask_bed
+# file mtimes record the last use, the least recently used are evicted first
+def mask_cache_dir():
+    return os.environ.get("APPLYMASK_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "applymask"))
 
-    new_sequence = apply_mask(mask, fasta_sequence)
+def mask_cache_size():
+    return int(os.environ.get("APPLYMASK_CACHE_SIZE", 256 * 1024 * 1024))
 
+def file_digest(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest
+
+def mask_cache_key(mask_filepath, mask_format, length):
+    digest = file_digest(mask_filepath)
+    digest.update(f"\0{mask_format}\0{length}".encode())
+    return digest.hexdigest()
+
+def save_compiled_mask(mask, compiled_filepath):
+    data = np.empty(1 + 2 * len(mask.starts), dtype=np.int64)
+    data[0] = -1 if mask.length is None else mask.length
+    data[1::2] = mask.starts
+    data[2::2] = mask.ends
+    with replace_on_success(compiled_filepath) as tmp_filepath, open(tmp_filepath, "wb") as f:
+        np.save(f, data)
+
+# the intervals are views on a single memory map
+def load_compiled_mask(compiled_filepath):
+    data = np.load(compiled_filepath, mmap_mode='r')
+    length = int(data[0])
+    return Mask(data[1::2], data[2::2], None if length < 0 else length)
+
+# per contig range masks (dict) are not cached, bed masks use their index
+def load_mask_cached(mask_filepath, mask_format, length=None, cache_dirpath=None):
+    if mask_format == "bed":
+        return set_mask_source(load_mask_bed(mask_filepath, length, True, cache_dirpath), mask_filepath, mask_format)
+    cache_dirpath = cache_dirpath or mask_cache_dir()
+    compiled_filepath = os.path.join(cache_dirpath, mask_cache_key(mask_filepath, mask_format, length) + ".npy")
+    try:
+        mask = set_mask_source(load_compiled_mask(compiled_filepath), mask_filepath, mask_format)
+        # a shared read-only cache is still used
+        with contextlib.suppress(OSError):
+            os.utime(compiled_filepath)
+        return mask
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    mask = load_mask(mask_filepath, mask_format, length)
+    if isinstance(mask, Mask):
+        try:
+            os.makedirs(cache_dirpath, exist_ok=True)
+            save_compiled_mask(mask, compiled_filepath)
+            evict_mask_cache(mask_cache_size(), cache_dirpath)
+        except OSError as e:
+            print(f"mask not cached: {e}", file=sys.stderr)
+    return mask
+
+# [(key, size in bytes, last use timestamp), ...] most recently used first
+def mask_cache_info(cache_dirpath=None):
+    cache_dirpath = cache_dirpath or mask_cache_dir()
+    entries = list()
+    for compiled_filepath in glob.glob(os.path.join(cache_dirpath, "*.npy")) + glob.glob(os.path.join(cache_dirpath, "*.npz")):
+        try:
+            stat = os.stat(compiled_filepath)
+        except FileNotFoundError:
+            continue
+        entries.append((pathlib.Path(compiled_filepath).stem, stat.st_size, stat.st_mtime))
+    return sorted(entries, key=lambda entry: entry[2], reverse=True)
+
+# remove least recently used masks until the cache fits in max_size bytes
+# returns the number of masks removed
+def evict_mask_cache(max_size, cache_dirpath=None):
+    cache_dirpath = cache_dirpath or mask_cache_dir()
+    entries = mask_cache_info(cache_dirpath)
+    total_size = sum(size for _, size, _ in entries)
+    removed = 0
+    while entries and total_size > max_size:
+        key, size, _ = entries.pop()
+        for extension in (".npy", ".npz"):
+            try:
+                os.remove(os.path.join(cache_dirpath, key + extension))
+            except FileNotFoundError:
+                pass
+        total_size -= size
+        removed += 1
+    return removed
+
+def clear_mask_cache(cache_dirpath=None):
+    return evict_mask_cache(0, cache_dirpath)
+
+def masked_fasta_filepath(fasta_filepath, use_gzip):
     fasta_filename = pathlib.Path(fasta_filepath).stem
-    if arg_is_true(use_gzip):
-        new_fasta_filepath = fasta_filename + '.masked.gz'
-    else:
-        new_fasta_filepath = fasta_filename + '.masked.fasta'
+    if use_gzip:
+        return fasta_filename + '.masked.gz'
+    return fasta_filename + '.masked.fasta'
+
+# range format per record, or bed named after the records
+def print_record_ranges(mask, records, bed=False):
+    for header, length in records:
+        record_mask = mask_for_record(mask, header)
+        if record_mask is None:
+            continue
+        if record_mask.length is None:
+            record_mask = record_mask.clip(length)
+        if bed:
+            print(get_mask_bed(record_mask, record_name(header)))
+            continue
+        if len(records) > 1:
+            print(header)
+        print(get_mask_ranges(record_mask))
+
+# high-water mark of the resident set size of this process in bytes, since it
+# started, never lower than at an earlier call
+def max_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def file_size(filepath):
+    try:
+        return os.path.getsize(filepath)
+    except (OSError, TypeError):
+        return 0
+
+# opt-in per stage wall time, cpu time, bytes read and written, and the process
+# rss high-water mark at the end of the stage with how much the stage raised it
+# instrumentation = Instrumentation(fasta="sample.fasta")
+# masker.mask_file("sample.fasta", "sample.masked.fasta", instrumentation=instrumentation)
+# instrumentation.record() -> {"fasta": ..., "stages": [...], "total": {...}}
+class Instrumentation:
+    def __init__(self, **context):
+        self.context = context
+        self.stages = list()
+
+    # yields the stage record, callers fill in bytes_read and bytes_written
+    @contextlib.contextmanager
+    def stage(self, name):
+        stage = {"stage": name, "bytes_read": 0, "bytes_written": 0}
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        rss_start = max_rss()
+        try:
+            yield stage
+        finally:
+            stage["wall_seconds"] = time.perf_counter() - wall_start
+            stage["cpu_seconds"] = time.process_time() - cpu_start
+            stage["max_rss_bytes"] = max_rss()
+            stage["max_rss_growth_bytes"] = None if rss_start is None else stage["max_rss_bytes"] - rss_start
+            self.stages.append(stage)
+
+    def record(self):
+        total = {key: sum(stage[key] for stage in self.stages) for key in ("wall_seconds", "cpu_seconds", "bytes_read", "bytes_written")}
+        total["max_rss_bytes"] = max_rss()
+        return dict(self.context, stages=self.stages, total=total)
+
+    # one json line, to stderr for "-" or appended to metrics_filepath
+    def emit(self, metrics_filepath):
+        line = json.dumps(self.record())
+        if metrics_filepath == "-":
+            print(line, file=sys.stderr)
+        else:
+            with open(metrics_filepath, "a") as f:
+                f.write(line + "\n")
+
+def instrument(instrumentation, name):
+    if instrumentation is None:
+        return contextlib.nullcontext(dict())
+    return instrumentation.stage(name)
+
+# mask one fasta file in memory, line by line, pipelined or patched in place
+# returns [(header, sequence length), ...] one tuple per record
+def mask_fasta_file(mask, fasta_filepath, new_fasta_filepath, use_gzip, stream=False, inplace=False, compresslevel=9, threads=1, pipeline=False, instrumentation=None):
+    if inplace and use_gzip:
+        raise ValueError("in place patching needs an uncompressed fasta")
+    if inplace or pipeline or stream:
+        mode = "inplace" if inplace else "pipeline" if pipeline else "stream"
+        with instrument(instrumentation, mode) as stage:
+            if inplace:
+                records = patch_fasta_inplace(mask, fasta_filepath, new_fasta_filepath)
+            elif pipeline:
+                records = mask_fasta_pipeline(mask, fasta_filepath, new_fasta_filepath, use_gzip, compresslevel, threads)
+            else:
+                records = mask_fasta_stream(mask, fasta_filepath, new_fasta_filepath, use_gzip, compresslevel, threads)
+            stage.update(bytes_read=file_size(fasta_filepath), bytes_written=file_size(new_fasta_filepath))
+        return records
+
+    with instrument(instrumentation, "load_fasta") as stage:
+        records = load_fasta_records(fasta_filepath, use_gzip)
+        stage["bytes_read"] = file_size(fasta_filepath)
+
+    with instrument(instrumentation, "apply_mask"):
+        new_records = list()
+        for header, sequence, chunk_len in records:
+            check_record_mask(mask, header, len(sequence))
+            record_mask = mask_for_record(mask, header)
+            if record_mask is not None:
+                sequence = apply_mask(record_mask, sequence)
+            new_records.append((header, sequence, chunk_len))
+
+    with instrument(instrumentation, "write_fasta") as stage:
+        save_fasta_records(new_fasta_filepath, new_records, use_gzip, compresslevel, threads)
+        stage["bytes_written"] = file_size(new_fasta_filepath)
+    return [(header, len(sequence)) for header, sequence, _ in records]
+
+# mask a writable bytes-like buffer (bytearray, memoryview, numpy array) in place
+# mask is a Mask or an expanded boolean array, see mask_to_array
+def mask_buffer(mask, buf):
+    seq_arr = np.frombuffer(buf, dtype=np.uint8)
+    mask_length = mask.length if isinstance(mask, Mask) else len(mask)
+    if mask_length is not None and mask_length < len(seq_arr):
+        raise IndexError(f"mask length {mask_length} is shorter than sequence length {len(seq_arr)}")
+    if isinstance(mask, Mask):
+        mask = mask.to_array(len(seq_arr))
+    seq_arr[mask[:len(seq_arr)]] = ord('N')
+    return buf
+
+# expanded masks a Masker keeps, one per mask and sequence length
+MASKER_ARRAYS = 8
+
+# in-process masking for pipelines, the mask is loaded once and reused
+# masker = Masker.from_file("mask.tsv", "range")
+# masker.mask_sequence(consensus)
+class Masker:
+    # mask is a Mask, a dict of Mask keyed by contig name or a MaskComposition
+    def __init__(self, mask):
+        self.mask = mask
+        # (id of the record mask, length) -> (record mask, boolean array), oldest first
+        # the mask is kept so its id isn't reused, the lock is for maskserver threads
+        self.arrays = collections.OrderedDict()
+        self.arrays_lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, mask_filepath, mask_format, length=None, cache=False):
+        mask = (load_mask_cached if cache else load_mask)(mask_filepath, mask_format, length)
+        if mask is None:
+            raise ValueError(f"unknown mask format: {mask_format}")
+        return cls(mask)
 
-    if arg_is_true(use_gzip):
-        save_fasta_gzip(new_fasta_filepath, fasta_header, new_sequence, fasta_chunk_len)
+    # bytearray and writable memoryview or numpy buffers are masked in place
+    # and returned without copying; str, bytes and read-only buffers are
+    # immutable and come back as a masked copy (str for str, bytes otherwise)
+    # header picks the contig of a per contig mask
+    def mask_sequence(self, sequence, header=None):
+        if not isinstance(self.mask, Mask) and header is None:
+            raise ValueError("a header is needed to pick the contig of a per contig mask")
+        mask = mask_for_record(self.mask, header) if header is not None else self.mask
+        if mask is None:
+            return sequence
+        mask_arr = self.mask_array(mask, len(sequence) if isinstance(sequence, str) else memoryview(sequence).nbytes)
+        if isinstance(sequence, str):
+            return apply_mask(mask_arr, sequence)
+        if isinstance(sequence, bytes) or memoryview(sequence).readonly:
+            return bytes(mask_buffer(mask_arr, bytearray(sequence)))
+        return mask_buffer(mask_arr, sequence)
+
+    # the mask expanded to length, built once for the sequences of that length
+    def mask_array(self, mask, length):
+        if mask.length is not None and mask.length < length:
+            raise IndexError(f"mask length {mask.length} is shorter than sequence length {length}")
+        key = (id(mask), length)
+        with self.arrays_lock:
+            if key in self.arrays:
+                self.arrays.move_to_end(key)
+                return self.arrays[key][1]
+        mask_arr = mask.to_array(length)
+        with self.arrays_lock:
+            self.arrays[key] = (mask, mask_arr)
+            if len(self.arrays) > MASKER_ARRAYS:
+                self.arrays.popitem(last=False)
+        return mask_arr
+
+    # binary file-like objects, fasta in and fasta out with the same wrapping
+    # returns [(header, sequence length), ...] one tuple per record
+    def mask_stream(self, f_in, f_out):
+        masker = FastaLineMasker(self.mask)
+        for line in f_in:
+            f_out.write(masker.mask_line(line))
+        masker.check_record()
+        return masker.record_lengths()
+
+    # options are passed on to mask_fasta_file
+    def mask_file(self, fasta_filepath, new_fasta_filepath, use_gzip=False, **options):
+        return mask_fasta_file(self.mask, fasta_filepath, new_fasta_filepath, use_gzip, **options)
+
+# options are passed on to mask_fasta_file: stream, inplace, compresslevel, threads, pipeline
+# metrics is a file to append a json instrumentation record to, "-" for stderr
+# mask_specs are further masks as path:format, combined with the first by
+# union, intersection or difference
+def main(mask_filepath, mask_format, fasta_filepath, use_gzip, print_mask_ranges, cache=False, metrics=None, manifest=False, mask_specs=(), combine="union", **options):
+    instrumentation = None
+    if metrics is not None:
+        instrumentation = Instrumentation(fasta=fasta_filepath, mask=mask_filepath, mask_format=mask_format)
+    try:
+        mask_main(mask_filepath, mask_format, fasta_filepath, use_gzip, print_mask_ranges, cache, instrumentation, manifest, mask_specs, combine, **options)
+    except Exception as e:
+        if instrumentation is not None:
+            instrumentation.context["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if instrumentation is not None:
+            instrumentation.emit(metrics)
+
+def mask_main(mask_filepath, mask_format, fasta_filepath, use_gzip, print_mask_ranges, cache, instrumentation, manifest=False, mask_specs=(), combine="union", **options):
+    # position masks are clipped to each record, range and bed masks are
+    # checked against it
+    all_mask_specs = [f"{mask_filepath}:{mask_format}", *mask_specs]
+    with instrument(instrumentation, "load_mask") as stage:
+        masks = load_masks(all_mask_specs, cache)
+        stage["bytes_read"] = sum(file_size(mask_spec.rpartition(':')[0]) for mask_spec in all_mask_specs)
+    if masks is None:
+        return
+    mask = compose_masks(masks, combine)
+
+    new_fasta_filepath = masked_fasta_filepath(fasta_filepath, arg_is_true(use_gzip))
+    records = mask_fasta_file(mask, fasta_filepath, new_fasta_filepath, arg_is_true(use_gzip), instrumentation=instrumentation, **options)
+    if manifest:
+        write_manifest(new_fasta_filepath, masks_version(mask_filepath, mask_format, mask_specs, combine), fasta_filepath)
+    if mask_specs:
+        report_contributions(all_mask_specs, masks, records, combine)
+
+    if arg_is_true(print_mask_ranges) or print_mask_ranges == "bed":
+        with instrument(instrumentation, "print_ranges"):
+            print_record_ranges(mask, records, print_mask_ranges == "bed")
+
+# manifest of the mask a masked fasta carries, written next to it as
+# <fasta>.manifest.json, so the fasta can later be re-masked incrementally
+def manifest_filepath(fasta_filepath):
+    return fasta_filepath + ".manifest.json"
+
+def mask_version(mask_filepath, mask_format):
+    return {"path": os.path.abspath(mask_filepath), "format": mask_format, "sha256": file_digest(mask_filepath).hexdigest()}
+
+# the version of a composition lists every mask
+def masks_version(mask_filepath, mask_format, mask_specs=(), combine="union"):
+    version = mask_version(mask_filepath, mask_format)
+    if mask_specs:
+        version["combine"] = combine
+        version["masks"] = [mask_version(*mask_spec.rsplit(':', 1)) for mask_spec in mask_specs]
+    return version
+
+def write_manifest(fasta_filepath, version, source_filepath):
+    manifest = {
+        "fasta": os.path.abspath(fasta_filepath),
+        "source": os.path.abspath(source_filepath),
+        "mask": version,
+        "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    with replace_on_success(manifest_filepath(fasta_filepath)) as tmp_filepath, open(tmp_filepath, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+def read_manifest(fasta_filepath):
+    with open(manifest_filepath(fasta_filepath)) as f:
+        return json.load(f)
+
+# re-mask a fasta masked earlier with another mask, see remask_fasta
+# previous_mask is path:format, by default the mask recorded in the fasta's
+# manifest, which must not have changed since
+# returns [(header, bases masked, bases restored)]
+def remask_main(mask_filepath, mask_format, fasta_filepath, use_gzip, source_filepath, previous_mask=None, cache=False):
+    if previous_mask is None:
+        try:
+            version = read_manifest(fasta_filepath)["mask"]
+        except FileNotFoundError:
+            raise ValueError(f"{fasta_filepath} has no manifest, pass the mask it was masked with as path:format")
+        if "masks" in version:
+            raise ValueError(f"{fasta_filepath} was masked with several masks, pass the mask it was masked with as path:format")
+        if file_digest(version["path"]).hexdigest() != version["sha256"]:
+            raise ValueError(f"{version['path']} changed since {fasta_filepath} was masked, pass the mask it was masked with as path:format")
+        previous_filepath, previous_format = version["path"], version["format"]
     else:
-        save_fasta(new_fasta_filepath, fasta_header, new_sequence, fasta_chunk_len)
+        previous_filepath, _, previous_format = previous_mask.rpartition(':')
+
+    load = load_mask_cached if cache else load_mask
+    previous = load(previous_filepath, previous_format)
+    mask = load(mask_filepath, mask_format)
+    if previous is None or mask is None:
+        return None
+    changes = remask_fasta(previous, mask, fasta_filepath, source_filepath, arg_is_true(use_gzip))
+    for header, masked, restored in changes:
+        print(f"{header}\t{masked} bases masked\t{restored} bases restored")
+    write_manifest(fasta_filepath, mask_version(mask_filepath, mask_format), source_filepath)
+    print(f'file {fasta_filepath} re-masked.')
+    return changes
+
+# masks as path:format, None when a format is unknown
+def load_masks(mask_specs, cache=False):
+    masks = list()
+    for mask_spec in mask_specs:
+        mask_filepath, _, mask_format = mask_spec.rpartition(':')
+        mask = (load_mask_cached if cache else load_mask)(mask_filepath, mask_format)
+        if mask is None:
+            return None
+        masks.append(mask)
+    return masks
+
+def report_contributions(mask_specs, masks, records, combine="union"):
+    contributions = mask_contributions(masks, records, combine)
+    print(f"mask\tmasked bases\tbases changed in the {combine}")
+    for mask_spec, (masked, changed) in zip(mask_specs, contributions):
+        print(f"{mask_spec}\t{masked}\t{changed}")
+
+# batch mode, the mask is parsed once and sent once to each worker process
+_worker_mask = None
+
+def _init_batch_worker(mask):
+    global _worker_mask
+    _worker_mask = mask
+
+def _batch_worker(job):
+    fasta_filepath, use_gzip, metrics, version, options = job
+    instrumentation = None
+    if metrics is not None:
+        instrumentation = Instrumentation(fasta=fasta_filepath)
+    try:
+        new_fasta_filepath = masked_fasta_filepath(fasta_filepath, use_gzip)
+        mask_fasta_file(_worker_mask, fasta_filepath, new_fasta_filepath, use_gzip, instrumentation=instrumentation, **options)
+        if version is not None:
+            write_manifest(new_fasta_filepath, version, fasta_filepath)
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    if instrumentation is not None:
+        if error is not None:
+            instrumentation.context["error"] = error
+        instrumentation.emit(metrics)
+    return fasta_filepath, error
+
+# glob patterns, or @file listing one fasta path per line
+# a file matched by several patterns is listed once, where first matched
+def expand_fasta_filepaths(patterns):
+    fasta_filepaths = dict()
+    for pattern in patterns:
+        if pattern.startswith('@'):
+            with open(pattern[1:]) as f:
+                matches = [line.strip() for line in f if line.strip()]
+        else:
+            matches = sorted(glob.glob(pattern)) or [pattern]
+        for fasta_filepath in matches:
+            fasta_filepaths.setdefault(os.path.realpath(fasta_filepath), fasta_filepath)
+    return list(fasta_filepaths.values())
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+# returns [(fasta_filepath, error), ...] for the files that failed
+# options are passed on to mask_fasta_file, see main
+# metrics gets one json instrumentation record per fasta
+def batch_main(mask_filepath, mask_format, fasta_patterns, use_gzip, processes=None, cache=False, metrics=None, manifest=False, mask_specs=(), combine="union", **options):
+    masks = load_masks([f"{mask_filepath}:{mask_format}", *mask_specs], cache)
+    if masks is None:
+        return None
+    mask = compose_masks(masks, combine)
 
-    if arg_is_true(print_mask_ranges):
-        print(get_mask_ranges(mask))
+    fasta_filepaths = expand_fasta_filepaths(fasta_patterns)
+    version = masks_version(mask_filepath, mask_format, mask_specs, combine) if manifest else None
+    # outputs are named after the input file name alone, inputs sharing a
+    # name in different directories would overwrite each other's output
+    outputs = collections.defaultdict(list)
+    for fasta_filepath in fasta_filepaths:
+        outputs[masked_fasta_filepath(fasta_filepath, arg_is_true(use_gzip))].append(fasta_filepath)
+    failures = [(fasta_filepath, f"output {new_fasta_filepath} is shared with {', '.join(other for other in inputs if other != fasta_filepath)}")
+                for new_fasta_filepath, inputs in outputs.items() if len(inputs) > 1 for fasta_filepath in inputs]
+    for i, (fasta_filepath, error) in enumerate(failures, 1):
+        print(f"[{i}/{len(fasta_filepaths)}] {fasta_filepath} failed: {error}")
+    jobs = [(inputs[0], arg_is_true(use_gzip), metrics, version, options) for inputs in outputs.values() if len(inputs) == 1]
+    if jobs:
+        with multiprocessing.Pool(processes or available_cores(), _init_batch_worker, (mask,)) as pool:
+            for i, (fasta_filepath, error) in enumerate(pool.imap_unordered(_batch_worker, jobs), len(failures) + 1):
+                if error is None:
+                    print(f"[{i}/{len(fasta_filepaths)}] {fasta_filepath} masked")
+                else:
+                    failures.append((fasta_filepath, error))
+                    print(f"[{i}/{len(fasta_filepaths)}] {fasta_filepath} failed: {error}")
+    print(f"{len(fasta_filepaths) - len(failures)} of {len(fasta_filepaths)} files masked")
+    return failures
 
 if __name__ == "__main__":
     p = argparse.ArgumentParser()
     p.add_argument("mask_filepath")
     p.add_argument("mask_format")
-    p.add_argument("fasta_filepath")
+    p.add_argument("fasta_filepath", help="fasta file, or glob patterns / @list files with --batch")
     p.add_argument("use_gzip")
-    p.add_argument("print_mask_ranges")
+    p.add_argument("print_mask_ranges", help="true to print the masked ranges, bed to print them as bed")
+    p.add_argument("--stream", action="store_true", help="mask line by line in constant memory")
+    p.add_argument("--batch", action="store_true", help="mask many fasta files on a process pool")
+    p.add_argument("--processes", type=int, help="batch worker processes, defaults to the available cores")
+    p.add_argument("--cache", action="store_true", help="reuse the compiled mask from the on-disk cache")
+    p.add_argument("--inplace", action="store_true", help="patch a copy of an uncompressed fasta through a memory map")
+    p.add_argument("--compresslevel", type=int, default=9, choices=range(0, 10), metavar="0-9", help="gzip compression level, default 9")
+    p.add_argument("--threads", type=int, default=1, help="gzip compression threads, 0 for the available cores")
+    p.add_argument("--pipeline", action="store_true", help="overlap decompression, masking and compression on threads")
+    p.add_argument("--metrics", metavar="PATH", help="append per stage timings and memory as json to PATH, - for stderr")
+    p.add_argument("--mask", dest="mask_specs", action="append", default=[], metavar="PATH:FORMAT", help="a further mask combined with the first, may be repeated")
+    p.add_argument("--combine", default="union", choices=COMBINE_OPERATIONS, help="how the masks are combined, default union")
+    p.add_argument("--manifest", action="store_true", help="record the mask in a manifest next to the masked fasta")
+    p.add_argument("--remask", metavar="SOURCE", help="re-mask fasta_filepath, masked earlier, in place from the unmasked SOURCE fasta")
+    p.add_argument("--previous-mask", metavar="PATH:FORMAT", help="the mask fasta_filepath was masked with, defaults to its manifest")
     args = p.parse_args()
-    main(args.mask_filepath, args.mask_format, args.fasta_filepath, args.use_gzip, args.print_mask_ranges)
+    if args.remask:
+        remask_main(args.mask_filepath, args.mask_format, args.fasta_filepath, args.use_gzip, args.remask, args.previous_mask, args.cache)
+        sys.exit(0)
+    options = dict(stream=args.stream, inplace=args.inplace, compresslevel=args.compresslevel, threads=args.threads or None, pipeline=args.pipeline)
+    if args.batch:
+        failures = batch_main(args.mask_filepath, args.mask_format, args.fasta_filepath.split(','), args.use_gzip, args.processes, args.cache, args.metrics, args.manifest, args.mask_specs, args.combine, **options)
+        sys.exit(1 if failures else 0)
+    main(args.mask_filepath, args.mask_format, args.fasta_filepath, args.use_gzip, args.print_mask_ranges, args.cache, args.metrics, args.manifest, args.mask_specs, args.combine, **options)
@@ -0,0 +1,145 @@
+#! /usr/bin/env python3
+
+# benchmark applymask on synthetic genome scale inputs
+# every stage (load, mask build, apply, write, range printing) is timed and
+# its peak python/numpy memory measured with tracemalloc
+# python3 benchmark.py --save            # store the baseline
+# python3 benchmark.py                   # fail on regressions against the baseline
+# python3 benchmark.py --length 100000   # quick run on a smaller genome
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import tracemalloc
+
+import numpy as np
+
+import applymask
+
+# H37Rv, NC_000962.3
+GENOME_LENGTH = 4411532
+CHUNK_LEN = 60
+CONTIGS = 4
+
+def random_sequence(length, rng):
+    return rng.choice(np.frombuffer(b"ACGT", dtype=np.uint8), length).tobytes().decode()
+
+# sparse masks cover about 0.1% of the genome in few regions, dense ones
+# about 10% in many short regions
+def random_mask(length, density, region_len, rng):
+    regions = max(1, int(length * density / region_len))
+    starts = rng.integers(0, length - region_len, regions)
+    return applymask.Mask.from_intervals(starts, starts + rng.integers(1, 2 * region_len, regions), length)
+
+# returns {name: filepath}
+def write_fixtures(dirpath, length, seed=0):
+    rng = np.random.default_rng(seed)
+    fixtures = dict()
+    sequence = random_sequence(length, rng)
+    fixtures["single"] = os.path.join(dirpath, "single.fasta")
+    applymask.save_fasta(fixtures["single"], ">NC_000962_3", sequence, CHUNK_LEN)
+    fixtures["single_gzip"] = os.path.join(dirpath, "single.fasta.gz")
+    applymask.save_fasta_gzip(fixtures["single_gzip"], ">NC_000962_3", sequence, CHUNK_LEN, compresslevel=1)
+    contig_len = length // CONTIGS
+    records = [(f">contig_{i}", sequence[i * contig_len:(i + 1) * contig_len], CHUNK_LEN) for i in range(CONTIGS)]
+    fixtures["multi"] = os.path.join(dirpath, "multi.fasta")
+    applymask.save_fasta_records(fixtures["multi"], records)
+
+    for density, fraction, region_len in (("sparse", 0.001, 50), ("dense", 0.1, 20)):
+        mask = random_mask(length, fraction, region_len, rng)
+        for mask_format in ("fasta", "position", "range"):
+            fixtures[f"{mask_format}_{density}"] = os.path.join(dirpath, f"{mask_format}_{density}.mask")
+            applymask.save_mask(mask, fixtures[f"{mask_format}_{density}"], mask_format, length)
+    return fixtures
+
+# wall time of one call, then peak traced memory of a second call
+def measure(fn):
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, {"seconds": seconds, "peak_bytes": peak_bytes}
+
+# {stage: {"seconds": ..., "peak_bytes": ...}}
+def run_benchmarks(dirpath, length=GENOME_LENGTH, seed=0):
+    fixtures = write_fixtures(dirpath, length, seed)
+    output = os.path.join(dirpath, "output")
+    results = dict()
+
+    def stage(name, fn):
+        result, results[name] = measure(fn)
+        print(f"{name}\t{results[name]['seconds']:.4f}s\t{results[name]['peak_bytes']} bytes", file=sys.stderr)
+        return result
+
+    header, sequence, chunk_len = stage("load_fasta", lambda: applymask.load_fasta(fixtures["single"]))
+    stage("load_fasta_gzip", lambda: applymask.load_fasta_gzip(fixtures["single_gzip"]))
+    stage("load_fasta_multi", lambda: applymask.load_fasta_records(fixtures["multi"]))
+
+    for density in ("sparse", "dense"):
+        for mask_format in ("fasta", "position", "range"):
+            mask = stage(f"load_mask_{mask_format}_{density}",
+                         lambda: applymask.load_mask(fixtures[f"{mask_format}_{density}"], mask_format, length))
+        masked = stage(f"apply_mask_{density}", lambda: applymask.apply_mask(mask, sequence))
+        stage(f"mask_ranges_{density}", lambda: applymask.get_mask_ranges(mask))
+        stage(f"stream_gzip_{density}", lambda: applymask.mask_fasta_stream(mask, fixtures["single_gzip"], output + ".gz", True, 1))
+        stage(f"patch_inplace_{density}", lambda: applymask.patch_fasta_inplace(mask, fixtures["single"], output))
+        stage(f"stream_multi_{density}", lambda: applymask.mask_fasta_stream(mask, fixtures["multi"], output, False))
+
+    stage("save_fasta", lambda: applymask.save_fasta(output, header, masked, chunk_len))
+    stage("save_fasta_gzip", lambda: applymask.save_fasta_gzip(output + ".gz", header, masked, chunk_len))
+    return results
+
+# stages slower or hungrier than baseline * (1 + threshold)
+# timings under min_seconds are too noisy to compare
+def find_regressions(results, baseline, threshold, min_seconds=0.01):
+    regressions = list()
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result["seconds"] > max(base["seconds"], min_seconds) * (1 + threshold):
+            regressions.append(f"{name}: {result['seconds']:.4f}s against {base['seconds']:.4f}s")
+        if result["peak_bytes"] > base["peak_bytes"] * (1 + threshold):
+            regressions.append(f"{name}: {result['peak_bytes']} bytes against {base['peak_bytes']} bytes")
+    return regressions
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--length", type=int, default=GENOME_LENGTH, help="genome length, default H37Rv")
+    p.add_argument("--baseline", default="benchmark_baseline.json")
+    p.add_argument("--save", action="store_true", help="store the results as the baseline")
+    p.add_argument("--threshold", type=float, default=0.5, help="allowed relative regression, default 0.5")
+    args = p.parse_args()
+
+    dirpath = tempfile.mkdtemp()
+    try:
+        results = run_benchmarks(dirpath, args.length)
+    finally:
+        shutil.rmtree(dirpath)
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump({"length": args.length, "stages": results}, f, indent=2, sort_keys=True)
+        print(f"baseline {args.baseline} saved.")
+        sys.exit(0)
+    if not os.path.exists(args.baseline):
+        print(f"no baseline {args.baseline}, run with --save first")
+        sys.exit(0)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["length"] != args.length:
+        print(f"baseline {args.baseline} was measured on a genome of length {baseline['length']}")
+        sys.exit(1)
+    regressions = find_regressions(results, baseline["stages"], args.threshold)
+    for regression in regressions:
+        print(regression)
+    print(f"{len(regressions)} regressions against {args.baseline}")
+    sys.exit(1 if regressions else 0)
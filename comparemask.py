@@ -1,6 +1,11 @@
 # compare the masks
 # return the differen positions
-# python3 compare.py
+# python3 comparemask.py tb/TB-exclude.txt position tb/TB-exclude-adaptive.txt position
+# python3 comparemask.py tb/NC_000962_2_repmask.array fasta tb/TB-exclude.txt position --ranges
+import argparse
+
+import applymask
+
 def load_position_mask(mask_filepath):
     with open(mask_filepath) as f:
         lines = f.readlines()
@@ -13,24 +18,15 @@ def load_position_mask(mask_filepath):
     return masked_positions
 
 def compare_position_mask(mask1, mask2):
-    mask1_set = set(mask1)
-    mask2_set = set(mask2)
-    diff1 = mask1_set - mask2_set
-    diff2 = mask2_set - mask1_set
-    diff_all = diff1.union(diff2)
-    return sorted(list(diff1)), sorted(list(diff2)), sorted(list(diff_all))
+    mask1 = applymask.Mask.from_positions(mask1)
+    mask2 = applymask.Mask.from_positions(mask2)
+    diff1 = mask1 - mask2
+    diff2 = mask2 - mask1
+    diff_all = mask1 ^ mask2
+    return diff1.positions().tolist(), diff2.positions().tolist(), diff_all.positions().tolist()
 
 def fasta_to_posistions(fasta_mask_file):
-    with open(fasta_mask_file) as f:
-        orig = f.readlines()
-        orig = [x.strip() for x in orig[1:]]
-        orig = ''.join(orig)
-    
-    out = []
-    for i,x in enumerate(orig):
-        if x == '1':
-            out.append(i)
-    return out
+    return applymask.load_mask_fasta(fasta_mask_file).positions().tolist()
 
 def write_position_to_file(mask, output_file):
     mask_str = [str(i) for i in mask]
@@ -39,19 +35,70 @@ def write_position_to_file(mask, output_file):
         f.write(mask_str_lines)
     return mask_str_lines
 
-if __name__ == '__main__':
-    inputfile1 = "tb/TB-exclude.txt"
-    masked_positions1 = load_position_mask(inputfile1)
+# any applymask format: fasta, position, range, bed
+def load_mask(mask_filepath, mask_format, length=None):
+    mask = applymask.load_mask(mask_filepath, mask_format, length)
+    if mask is None:
+        raise ValueError(f"unknown mask format: {mask_format}")
+    return mask
+
+# masked base counts per side and the intervals where the masks differ
+def compare_masks(mask1, mask2):
+    only1 = mask1 - mask2
+    only2 = mask2 - mask1
+    return {
+        "mask1": mask1.masked_count(),
+        "mask2": mask2.masked_count(),
+        "both": (mask1 & mask2).masked_count(),
+        "only1": only1,
+        "only2": only2,
+        "union": (mask1 | mask2).masked_count(),
+    }
 
-    inputfile2 = "tb/TB-exclude-adaptive.txt"
-    masked_positions2 = load_position_mask(inputfile2)
+# an empty mask for contigs missing from a per contig mask
+def contig_mask(mask, contig, length):
+    mask = applymask.mask_for_record(mask, '>' + contig)
+    if mask is None:
+        return applymask.Mask([], [], length)
+    return mask
 
-    diff1_2, diff2_1, diff_all = compare_position_mask(masked_positions1, masked_positions2)
-    
-    print(len(diff1_2))
-    print(len(diff2_1))
-    print(len(diff_all))
+def print_comparison(comparison, print_ranges, name=None):
+    prefix = f"{name}\t" if name is not None else ""
+    print(f"{prefix}mask1\t{comparison['mask1']}")
+    print(f"{prefix}mask2\t{comparison['mask2']}")
+    print(f"{prefix}both\t{comparison['both']}")
+    print(f"{prefix}only mask1\t{comparison['only1'].masked_count()}")
+    print(f"{prefix}only mask2\t{comparison['only2'].masked_count()}")
+    print(f"{prefix}union\t{comparison['union']}")
+    if print_ranges:
+        # diff style, < only in mask1, > only in mask2, ranges inclusive
+        for marker, mask in (("<", comparison["only1"]), (">", comparison["only2"])):
+            for begin, end in mask:
+                print(f"{prefix}{marker}\t{begin}\t{end - 1}")
 
-    inputfile3 = "tb/NC_000962_2_repmask.array"
-    masked_positions3 = fasta_to_posistions(inputfile3)
-    result = write_position_to_file(masked_positions3, 'tb/repmask.txt')
+def main(mask_filepath1, mask_format1, mask_filepath2, mask_format2, length=None, print_ranges=False):
+    mask1 = load_mask(mask_filepath1, mask_format1, length)
+    mask2 = load_mask(mask_filepath2, mask_format2, length)
+    if not isinstance(mask1, dict) and not isinstance(mask2, dict):
+        comparison = compare_masks(mask1, mask2)
+        print_comparison(comparison, print_ranges)
+        return comparison
+
+    # per contig masks are compared contig by contig, a plain mask applies to every contig
+    contigs = sorted(set(mask1 if isinstance(mask1, dict) else ()) | set(mask2 if isinstance(mask2, dict) else ()))
+    comparisons = dict()
+    for contig in contigs:
+        comparisons[contig] = compare_masks(contig_mask(mask1, contig, length), contig_mask(mask2, contig, length))
+        print_comparison(comparisons[contig], print_ranges, contig)
+    return comparisons
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument("mask_filepath1")
+    p.add_argument("mask_format1", help="fasta, position, range or bed")
+    p.add_argument("mask_filepath2")
+    p.add_argument("mask_format2", help="fasta, position, range or bed")
+    p.add_argument("--length", type=int, help="genome length, position and range masks are clipped to it")
+    p.add_argument("--ranges", action="store_true", help="print the ranges where the masks differ")
+    args = p.parse_args()
+    main(args.mask_filepath1, args.mask_format1, args.mask_filepath2, args.mask_format2, args.length, args.ranges)
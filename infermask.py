@@ -0,0 +1,90 @@
+#! /usr/bin/env python3
+
+# infer a candidate mask from a collection of samples aligned to a reference
+# a position is masked when
+#  - the reference base isn't one of ACGT
+#  - at least n_fraction of the samples have no ACGT call there (N, gap, ...)
+#  - the samples carry two or more alt alleles there, so the distances
+#    through that position are inconsistent with a single snp
+# every sample is read once and counted with vectorized per base passes
+# python3 infermask.py tb/NC_000962_3.fasta samples/*.fasta.gz --output inferred.tsv --format range
+import sys
+import argparse
+
+import numpy as np
+
+import applymask
+import snpdistance
+
+class SiteCounts:
+    def __init__(self, reference):
+        self.reference = snpdistance.encode_sequences([reference])[0]
+        self.length = len(self.reference)
+        self.samples = 0
+        # per position count of every ACGT allele, and of the unknown calls
+        self.allele_counts = np.zeros((4, self.length), dtype=np.uint32)
+        self.unknown_counts = np.zeros(self.length, dtype=np.uint32)
+
+    def add(self, sequence):
+        encoded = snpdistance.encode_sequences([sequence])[0]
+        if len(encoded) != self.length:
+            raise ValueError(f"sample length {len(encoded)} differs from the reference length {self.length}")
+        for code in range(4):
+            self.allele_counts[code] += encoded == code
+        self.unknown_counts += encoded == snpdistance.UNKNOWN
+        self.samples += 1
+
+    # {reason: Mask}
+    def masks(self, n_fraction=0.5, min_allele_count=1):
+        unknown_reference = self.reference == snpdistance.UNKNOWN
+        consistent_n = self.unknown_counts >= max(1, n_fraction * self.samples)
+        # alt alleles seen in enough samples, the reference allele never counts
+        alleles = self.allele_counts >= min_allele_count
+        known = np.flatnonzero(~unknown_reference)
+        alleles[self.reference[known], known] = False
+        multiallelic = alleles.sum(axis=0) >= 2
+        return {
+            "reference": applymask.Mask.from_array(unknown_reference),
+            "n": applymask.Mask.from_array(consistent_n),
+            "multiallelic": applymask.Mask.from_array(multiallelic),
+        }
+
+    def mask(self, n_fraction=0.5, min_allele_count=1):
+        mask = applymask.Mask([], [], self.length)
+        for reason_mask in self.masks(n_fraction, min_allele_count).values():
+            mask = mask | reason_mask
+        return mask
+
+# samples is any iterable of sequences, e.g. a generator over a multi-fasta
+# samples of the wrong length are skipped
+def infer_mask(reference, samples, n_fraction=0.5, min_allele_count=1):
+    counts = SiteCounts(reference)
+    for i, sample in enumerate(samples):
+        try:
+            counts.add(sample)
+        except ValueError as e:
+            print(f"sample {i} skipped: {e}", file=sys.stderr)
+    return counts
+
+def main(reference_filepath, fasta_filepaths, output_filepath, mask_format, n_fraction=0.5, min_allele_count=1):
+    header, reference, _ = applymask.load_fasta_records(reference_filepath, reference_filepath.endswith(".gz"))[0]
+    samples = (sequence for fasta_filepath in applymask.expand_fasta_filepaths(fasta_filepaths)
+               for _, sequence, _ in applymask.read_fasta_records(fasta_filepath, fasta_filepath.endswith(".gz")))
+    counts = infer_mask(reference, samples, n_fraction, min_allele_count)
+    for reason, reason_mask in counts.masks(n_fraction, min_allele_count).items():
+        print(f"{reason}\t{reason_mask.masked_count()}")
+    mask = counts.mask(n_fraction, min_allele_count)
+    print(f"{counts.samples} samples, {mask.masked_count()} of {counts.length} positions masked")
+    applymask.save_mask(mask, output_filepath, mask_format, chrom=applymask.record_name(header))
+    return mask
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("reference_filepath")
+    p.add_argument("fasta_filepaths", nargs="+", help="multi-fasta files or glob patterns of samples aligned to the reference, or @list_file")
+    p.add_argument("--output", required=True, help="candidate mask file")
+    p.add_argument("--format", default="range", help="range, position or bed, default range")
+    p.add_argument("--n-fraction", type=float, default=0.5, help="mask positions without an ACGT call in at least this fraction of samples")
+    p.add_argument("--min-allele-count", type=int, default=1, help="samples an alt allele needs to count towards multiallelic sites")
+    args = p.parse_args()
+    main(args.reference_filepath, args.fasta_filepaths, args.output, args.format, args.n_fraction, args.min_allele_count)
@@ -0,0 +1,126 @@
+#! /usr/bin/env python3
+
+# mask every sample of a multi-fasta alignment of equal length samples
+# the samples are loaded into one (samples, length) uint8 array, spilled to a
+# memory mapped temporary file when larger than the memory limit, and the
+# mask is written into every row with a single broadcast assignment
+# python3 maskalignment.py tb/TB-exclude.txt position core.aln.fasta.gz core.masked.fasta.gz
+# python3 maskalignment.py tb/TB-exclude.txt position core.aln.fasta core.snps.fasta --snps-only --columns core.snps.positions
+import os
+import argparse
+import tempfile
+
+import numpy as np
+
+import applymask
+import snpdistance
+
+# rows per block when scanning or writing the alignment
+BLOCK_ROWS = 256
+
+# bytes of memory available, None when unknown
+def available_memory():
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+# returns (headers, alignment, chunk_len)
+# alignment is a writable (samples, length) uint8 array, a np.memmap of an
+# anonymous temporary file in tmp_dirpath once it outgrows memory_limit bytes
+# memory_limit defaults to half the available memory
+def load_alignment(fasta_filepath, use_gzip=False, memory_limit=None, tmp_dirpath=None):
+    if memory_limit is None:
+        memory_limit = (available_memory() or 1 << 62) // 2
+    headers, rows, spill = list(), bytearray(), None
+    length, chunk_len = None, None
+    try:
+        for header, sequence, record_chunk_len in applymask.read_fasta_records(fasta_filepath, use_gzip):
+            if length is None:
+                length, chunk_len = len(sequence), record_chunk_len
+            elif len(sequence) != length:
+                raise ValueError(f"{header} has length {len(sequence)}, expected {length}")
+            headers.append(header)
+            if spill is None and len(rows) + length > memory_limit:
+                spill = tempfile.TemporaryFile(dir=tmp_dirpath)
+                spill.write(rows)
+                rows = None
+            if spill is None:
+                rows += sequence.encode()
+            else:
+                spill.write(sequence.encode())
+        shape = (len(headers), length or 0)
+        if spill is None:
+            return headers, np.frombuffer(rows, dtype=np.uint8).reshape(shape), chunk_len
+        spill.flush()
+        return headers, np.memmap(spill, dtype=np.uint8, mode="r+", shape=shape), chunk_len
+    finally:
+        # the memory map keeps the unlinked file alive
+        if spill is not None:
+            spill.close()
+
+# write N into the masked columns of every row, in place
+def mask_alignment(mask, alignment):
+    columns = applymask.as_mask(mask).clip(alignment.shape[1]).positions()
+    for start in range(0, alignment.shape[0], BLOCK_ROWS):
+        alignment[start:start + BLOCK_ROWS, columns] = ord('N')
+    return alignment
+
+# boolean per column, True where the samples carry two or more ACGT bases
+def variable_columns(alignment):
+    seen = None
+    for start in range(0, alignment.shape[0], BLOCK_ROWS):
+        seen = snpdistance.seen_bases(snpdistance.CODES[alignment[start:start + BLOCK_ROWS]], seen)
+    if seen is None:
+        return np.zeros(alignment.shape[1], dtype=bool)
+    return snpdistance.variable_columns(seen)
+
+# write the alignment, or only its columns when given, wrapped at chunk_len
+def save_alignment(fasta_filepath, headers, alignment, chunk_len, columns=None, use_gzip=False, compresslevel=9, threads=1):
+    with applymask.open_fasta(fasta_filepath, "wb", use_gzip, compresslevel, threads) as f:
+        for i, header in enumerate(headers):
+            row = alignment[i] if columns is None else alignment[i, columns]
+            f.write((("\n" if i else "") + header + "\n").encode())
+            applymask.write_wrapped(f, row, chunk_len)
+    print(f'file {fasta_filepath} created.')
+
+def main(mask_filepath, mask_format, fasta_filepath, new_fasta_filepath, drop_masked=False, snps_only=False, columns_filepath=None, memory_limit=None, tmp_dirpath=None, compresslevel=9, threads=1):
+    mask = applymask.load_mask(mask_filepath, mask_format)
+    if mask is None:
+        return None
+    if isinstance(mask, dict):
+        raise ValueError("expected a fasta, position or range mask without a chrom column")
+    headers, alignment, chunk_len = load_alignment(fasta_filepath, fasta_filepath.endswith(".gz"), memory_limit, tmp_dirpath)
+    print(f"{len(headers)} samples of length {alignment.shape[1]}{' memory mapped' if isinstance(alignment, np.memmap) else ''}")
+    mask = mask.clip(alignment.shape[1])
+    mask_alignment(mask, alignment)
+
+    columns = None
+    if snps_only:
+        columns = np.flatnonzero(variable_columns(alignment))
+    elif drop_masked:
+        columns = np.flatnonzero(~mask.to_array(alignment.shape[1]))
+    if columns is not None:
+        print(f"{len(columns)} of {alignment.shape[1]} columns kept")
+        if columns_filepath is not None:
+            with open(columns_filepath, "w") as f:
+                f.write("\n".join(map(str, columns.tolist())))
+    save_alignment(new_fasta_filepath, headers, alignment, chunk_len, columns, new_fasta_filepath.endswith(".gz"), compresslevel, threads)
+    return headers, columns
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("mask_filepath")
+    p.add_argument("mask_format", help="fasta, position or range")
+    p.add_argument("fasta_filepath", help="multi-fasta alignment of equal length samples, gzip when ending in .gz")
+    p.add_argument("new_fasta_filepath", help="masked alignment, gzip when ending in .gz")
+    p.add_argument("--drop-masked", action="store_true", help="leave the masked columns out")
+    p.add_argument("--snps-only", action="store_true", help="keep only the unmasked columns with two or more ACGT bases")
+    p.add_argument("--columns", dest="columns_filepath", help="write the positions of the kept columns, one per line")
+    p.add_argument("--memory-limit", type=int, help="bytes of alignment held in memory before memory mapping it, default half the available memory")
+    p.add_argument("--tmp-dir", help="directory of the memory mapped alignment, default the system temporary directory")
+    p.add_argument("--compresslevel", type=int, default=9, choices=range(0, 10), metavar="0-9", help="gzip compression level, default 9")
+    p.add_argument("--threads", type=int, default=1, help="gzip compression threads, 0 for the available cores")
+    args = p.parse_args()
+    main(args.mask_filepath, args.mask_format, args.fasta_filepath, args.new_fasta_filepath, args.drop_masked, args.snps_only,
+         args.columns_filepath, args.memory_limit, args.tmp_dir, args.compresslevel, args.threads or None)
@@ -0,0 +1,30 @@
+#! /usr/bin/env python3
+
+# inspect and clear the compiled mask cache used by applymask.py --cache
+# python3 maskcache.py info
+# python3 maskcache.py evict 100000000
+# python3 maskcache.py clear
+import time
+import argparse
+
+import applymask
+
+def print_cache_info(cache_dirpath=None):
+    entries = applymask.mask_cache_info(cache_dirpath)
+    for key, size, last_used in entries:
+        print(f"{key}\t{size}\t{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_used))}")
+    print(f"{len(entries)} masks, {sum(size for _, size, _ in entries)} bytes in {cache_dirpath or applymask.mask_cache_dir()}")
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("command", choices=["info", "evict", "clear"])
+    p.add_argument("max_size", nargs="?", type=int, help="cache size limit in bytes for evict")
+    p.add_argument("--cache-dir", help="defaults to $APPLYMASK_CACHE_DIR or ~/.cache/applymask")
+    args = p.parse_args()
+    if args.command == "info":
+        print_cache_info(args.cache_dir)
+    elif args.command == "evict":
+        max_size = applymask.mask_cache_size() if args.max_size is None else args.max_size
+        print(f"{applymask.evict_mask_cache(max_size, args.cache_dir)} masks removed")
+    else:
+        print(f"{applymask.clear_mask_cache(args.cache_dir)} masks removed")
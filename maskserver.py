@@ -0,0 +1,138 @@
+#! /usr/bin/env python3
+
+# masking daemon
+# loads named masks once, then masks fasta files on request over a unix socket
+# python3 maskserver.py /tmp/applymask.sock tb=tb/TB-exclude.txt:position repmask=tb/repmask.array:fasta
+#
+# one json request per line, one json response per line
+# {"mask": "tb", "input": "sample.fasta.gz", "output": "sample.masked.gz", "gzip": true, "stream": true}
+# {"ok": true, "output": "sample.masked.gz", "records": [[">NC_000962_3", 4411532]], "seconds": 0.41}
+# {"command": "metrics"}
+# {"ok": true, "requests": 12, "errors": 0, "latency_buckets": {"0.01": 0, ..., "inf": 0}, ...}
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+import socketserver
+
+import applymask
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+# mask_fasta_file options a request may set
+REQUEST_OPTIONS = ("stream", "inplace", "pipeline", "compresslevel", "threads")
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, seconds, ok):
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+        with self.lock:
+            self.requests += 1
+            self.errors += 0 if ok else 1
+            self.total_seconds += seconds
+            self.bucket_counts[bucket] += 1
+
+    def snapshot(self):
+        with self.lock:
+            buckets = {str(bound): count for bound, count in zip(LATENCY_BUCKETS, self.bucket_counts)}
+            buckets["inf"] = self.bucket_counts[-1]
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "total_seconds": self.total_seconds,
+                "latency_buckets": buckets,
+            }
+
+class MaskRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.run_request(line)
+            self.wfile.write((json.dumps(response) + "\n").encode())
+
+# each connection is served on its own thread
+class MaskServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    # masks is a dict of applymask.Masker keyed by name
+    def __init__(self, socket_path, masks):
+        self.masks = masks
+        self.metrics = Metrics()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, MaskRequestHandler)
+
+    def run_request(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return {"ok": False, "error": f"invalid request: {e}"}
+        if isinstance(request, dict) and request.get("command") == "metrics":
+            return dict(ok=True, masks=sorted(self.masks), **self.metrics.snapshot())
+
+        start = time.perf_counter()
+        try:
+            response = self.mask_request(request)
+        except Exception as e:
+            response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        response["seconds"] = time.perf_counter() - start
+        self.metrics.record(response["seconds"], response["ok"])
+        return response
+
+    def mask_request(self, request):
+        if not isinstance(request, dict):
+            raise ValueError(f"expected a json object, got {type(request).__name__}")
+        if request.get("mask") not in self.masks:
+            raise KeyError(f"unknown mask {request.get('mask')!r}, expected one of {sorted(self.masks)}")
+        use_gzip = bool(request.get("gzip", False))
+        fasta_filepath = request["input"]
+        new_fasta_filepath = request.get("output") or applymask.masked_fasta_filepath(fasta_filepath, use_gzip)
+        options = {name: request[name] for name in REQUEST_OPTIONS if name in request}
+        records = self.masks[request["mask"]].mask_file(fasta_filepath, new_fasta_filepath, use_gzip, **options)
+        return {"ok": True, "output": new_fasta_filepath, "records": records}
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+# name=path:format -> (name, applymask.Masker)
+def load_named_mask(spec, cache=False):
+    name, _, mask_spec = spec.partition('=')
+    mask_filepath, _, mask_format = mask_spec.rpartition(':')
+    if not name or not mask_filepath:
+        raise ValueError(f"expected name=path:format, got {spec!r}")
+    return name, applymask.Masker.from_file(mask_filepath, mask_format, cache=cache)
+
+# client side, returns the decoded response
+def send_request(socket_path, request):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile("rwb") as f:
+            f.write((json.dumps(request) + "\n").encode())
+            f.flush()
+            return json.loads(f.readline())
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("socket_path")
+    p.add_argument("masks", nargs="+", help="name=path:format, format one of fasta, position, range, bed")
+    p.add_argument("--cache", action="store_true", help="reuse compiled masks from the on-disk cache")
+    args = p.parse_args()
+    masks = dict(load_named_mask(spec, args.cache) for spec in args.masks)
+    with MaskServer(args.socket_path, masks) as server:
+        print(f"serving {', '.join(sorted(masks))} on {args.socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,146 @@
+#! /usr/bin/env python3
+
+# masked pairwise snp distances between equal length sequences
+# a difference counts when both bases are one of ACGT, they differ and the
+# position is not masked; N, gaps and other codes never count
+# python3 snpdistance.py samples.fasta.gz --mask tb/TB-exclude.txt --mask-format position --cutoff 12
+import argparse
+import multiprocessing
+
+import numpy as np
+
+import applymask
+
+UNKNOWN = 4
+
+# byte -> 0..3 for ACGT (any case), UNKNOWN for everything else
+CODES = np.full(256, UNKNOWN, dtype=np.uint8)
+for code, bases in enumerate((b"Aa", b"Cc", b"Gg", b"Tt")):
+    CODES[np.frombuffer(bases, dtype=np.uint8)] = code
+
+# bytes of the pairwise comparison held in memory at once per block
+BLOCK_BUDGET = 64 * 1024 * 1024
+
+# (samples, length) uint8 array of base codes
+def encode_sequences(sequences):
+    lengths = {len(sequence) for sequence in sequences}
+    if len(lengths) > 1:
+        raise ValueError(f"sequences have different lengths: {sorted(lengths)}")
+    encoded = np.empty((len(sequences), lengths.pop() if lengths else 0), dtype=np.uint8)
+    for i, sequence in enumerate(sequences):
+        if isinstance(sequence, str):
+            sequence = sequence.encode()
+        encoded[i] = CODES[np.frombuffer(sequence, dtype=np.uint8)]
+    return encoded
+
+# drop the masked columns, and the columns where every known base agrees
+# since they add nothing to any distance
+def informative_columns(encoded, mask=None):
+    keep = variable_columns(seen_bases(encoded))
+    if mask is not None:
+        keep &= ~applymask.as_mask(mask).to_array(encoded.shape[1])
+    return encoded[:, keep]
+
+# bit per base seen in each column, UNKNOWN sets bit 4
+# seen accumulates over successive blocks of rows
+def seen_bases(encoded, seen=None):
+    if seen is None:
+        seen = np.zeros(encoded.shape[1], dtype=np.uint8)
+    for row in encoded:
+        seen |= np.left_shift(np.uint8(1), row)
+    return seen
+
+# columns where two or more different ACGT bases were seen
+def variable_columns(seen):
+    known = seen & 0b1111
+    return (known & (known - 1)) != 0
+
+# distances of the pairs (rows[k], cols[k]), pairs are dropped as soon as
+# they exceed the cutoff
+def pair_distances(encoded, rows, cols, cutoff=None):
+    distances = np.zeros(len(rows), dtype=np.int64)
+    active = np.arange(len(rows))
+    column_chunk = max(1, BLOCK_BUDGET // max(1, len(rows)))
+    for start in range(0, encoded.shape[1], column_chunk):
+        if not len(active):
+            break
+        a = encoded[rows[active], start:start + column_chunk]
+        b = encoded[cols[active], start:start + column_chunk]
+        distances[active] += np.count_nonzero((a != b) & (a != UNKNOWN) & (b != UNKNOWN), axis=1)
+        if cutoff is not None:
+            active = active[distances[active] <= cutoff]
+    return distances
+
+# pairs (i, j), i < j, for the rows of one block
+def block_pairs(first_row, last_row, samples):
+    block = np.arange(first_row, last_row)
+    counts = samples - 1 - block
+    rows = np.repeat(block, counts)
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    cols = np.arange(len(rows)) - offsets + rows + 1
+    return rows, cols
+
+# worker process state, the encoded samples are sent once per worker
+_worker_encoded = None
+
+def _init_worker(encoded):
+    global _worker_encoded
+    _worker_encoded = encoded
+
+def _block_worker(job):
+    first_row, last_row, cutoff = job
+    return block_distances(_worker_encoded, first_row, last_row, cutoff)
+
+def block_distances(encoded, first_row, last_row, cutoff):
+    rows, cols = block_pairs(first_row, last_row, encoded.shape[0])
+    distances = pair_distances(encoded, rows, cols, cutoff)
+    if cutoff is not None:
+        keep = distances <= cutoff
+        rows, cols, distances = rows[keep], cols[keep], distances[keep]
+    return rows, cols, distances
+
+# returns the (samples, samples) distance matrix, or with a cutoff the sparse
+# list [(i, j, distance), ...] of the pairs i < j within the cutoff
+# rows are handed out to the workers in blocks of block_rows
+def snp_distances(sequences, mask=None, cutoff=None, processes=1, block_rows=64):
+    encoded = informative_columns(encode_sequences(sequences), mask)
+    samples = encoded.shape[0]
+    jobs = [(first_row, min(first_row + block_rows, samples), cutoff) for first_row in range(0, samples, block_rows)]
+    if processes == 1:
+        results = [block_distances(encoded, *job) for job in jobs]
+    else:
+        with multiprocessing.Pool(processes or applymask.available_cores(), _init_worker, (encoded,)) as pool:
+            results = pool.map(_block_worker, jobs)
+
+    if cutoff is not None:
+        return sorted((i, j, d) for rows, cols, distances in results for i, j, d in zip(rows.tolist(), cols.tolist(), distances.tolist()))
+    matrix = np.zeros((samples, samples), dtype=np.int64)
+    for rows, cols, distances in results:
+        matrix[rows, cols] = distances
+        matrix[cols, rows] = distances
+    return matrix
+
+def main(fasta_filepath, mask_filepath=None, mask_format=None, cutoff=None, processes=1):
+    records = applymask.load_fasta_records(fasta_filepath, fasta_filepath.endswith(".gz"))
+    names = [applymask.record_name(header) for header, _, _ in records]
+    mask = None
+    if mask_filepath is not None:
+        mask = applymask.load_mask(mask_filepath, mask_format)
+        if mask is None or isinstance(mask, dict):
+            raise ValueError("expected a fasta, position or range mask without a chrom column")
+    distances = snp_distances([sequence for _, sequence, _ in records], mask, cutoff, processes)
+    if cutoff is None:
+        rows, cols = np.triu_indices(len(names), 1)
+        distances = zip(rows.tolist(), cols.tolist(), distances[rows, cols].tolist())
+    for i, j, distance in distances:
+        print(f"{names[i]}\t{names[j]}\t{distance}")
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("fasta_filepath", help="multi-fasta of equal length samples, gzip when ending in .gz")
+    p.add_argument("--mask", dest="mask_filepath")
+    p.add_argument("--mask-format", default="position", help="fasta, position or range")
+    p.add_argument("--cutoff", type=int, help="only report pairs within this distance")
+    p.add_argument("--processes", type=int, default=1, help="0 for the available cores")
+    args = p.parse_args()
+    main(args.fasta_filepath, args.mask_filepath, args.mask_format, args.cutoff, args.processes or None)
@@ -6,7 +6,15 @@
 # Generate code coverage html report: coverage html
 
 import os
+import shutil
+import io
+import gzip
+import json
+import re
+import contextlib
+import tempfile
 import unittest
+import unittest.mock
 import applymask
 
 def assert_fasta(self, fasta_name, sequence):
@@ -64,6 +72,8 @@ class TestApplyMask(unittest.TestCase):
     def tearDownClass(cls):
         os.remove("test.masked.fasta")
         os.remove("test.fasta.masked.gz")
+        if os.path.exists("test.masked.fasta.manifest.json"):
+            os.remove("test.masked.fasta.manifest.json")
 
     def test_list_to_range_str_1(self):
         data = [1,2,3,4,5,7]
@@ -86,23 +96,138 @@ class TestApplyMask(unittest.TestCase):
         result = applymask.lst_to_range_str(data)
         self.assertEqual(expected, result)
 
+    def test_list_to_range_str_4(self):
+        self.assertEqual(applymask.lst_to_range_str([0, 1, 2]), [(0,2)])
+        self.assertEqual(applymask.lst_to_range_str([3, 5, 6, 7]), [(3,3),(5,7)])
+        self.assertEqual(applymask.lst_to_range_str([]), [])
+
     def test_load_mask_range_aux(self):
         data = ["0\t0","5\t7", "9\t9"]
-        expected = list("1000011101")
+        expected = "1000011101"
 
         result = applymask.load_mask_range_aux(data, 10)
-        self.assertEqual(result, expected)
+        self.assertEqual(result.to_string(), expected)
 
     def test_load_mask_range_aux_exception(self):
         data = ["0\ta","5\t7", "9\t9"]
         self.assertRaises(Exception, applymask.load_mask_range_aux(data,10))
 
+    def test_load_mask_range_aux_comments(self):
+        data = ["begin\tend", "# masked ranges", "0\t0", "", "5 7", "9\t9", ""]
+        result = applymask.load_mask_range_aux(data, 10)
+        self.assertEqual(result.to_string(), "1000011101")
+
+    def test_load_mask_range_aux_malformed(self):
+        data = ["0\t0", "5\ta", "7\t5", "9\t9", "1\t2\t3"]
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            result = applymask.load_mask_range_aux(data, 10)
+        self.assertEqual(list(result), [(0,1),(9,10)])
+        self.assertEqual(output.getvalue(), "3 malformed masked range lines skipped: line 2, 3, 5\n")
+
+    def test_load_mask_range_aux_outside_genome(self):
+        with self.assertRaisesRegex(ValueError, "2 masked ranges outside the genome of length 10: line 2, 3"):
+            applymask.load_mask_range_aux(["0\t0", "5\t10", "-1\t2"], 10)
+        self.assertEqual(list(applymask.load_mask_range_aux(["5\t10"], None)), [(5,11)])
+
+    def test_check_record_mask(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            mask_filepath = os.path.join(dirpath, "mask.tsv")
+            with open(mask_filepath, "w") as f:
+                f.write("0\t5\n590\t700\n")
+            mask = applymask.load_mask(mask_filepath, "range")
+            new_fasta_filepath = os.path.join(dirpath, "test.masked.fasta")
+            for options in (dict(), dict(stream=True), dict(pipeline=True), dict(inplace=True)):
+                with self.assertRaisesRegex(ValueError, "1 masked ranges outside the genome of length 600: line 2"):
+                    applymask.mask_fasta_file(mask, "data/test.fasta", new_fasta_filepath, False, **options)
+            # a composition checks each of its masks
+            composition = applymask.compose_masks([applymask.load_mask("data/mask_range_contig.tsv", "range"), mask])
+            with self.assertRaisesRegex(ValueError, "line 2"):
+                applymask.check_record_mask(composition, ">contig_1", 20)
+
+            # per contig masks are checked against their own record
+            mask = applymask.load_mask("data/mask_range_contig.tsv", "range")
+            applymask.check_record_mask(mask, ">contig_1 first", 20)
+            with self.assertRaisesRegex(ValueError, "1 masked ranges outside the genome of length 15: line 2"):
+                applymask.check_record_mask(mask, ">contig_1 first", 15)
+            with self.assertRaisesRegex(ValueError, "line 4"):
+                applymask.check_record_mask(applymask.load_mask("data/mask_bed.bed", "bed"), ">contig_3", 9)
+            # masks built in code carry no file and are clipped as before
+            applymask.check_record_mask(applymask.Mask.from_ranges([(590, 700)]), ">a", 600)
+
+    def test_main_mask_specs_outside_record(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            mask_filepath = os.path.join(dirpath, "mask.tsv")
+            with open(mask_filepath, "w") as f:
+                f.write("590\t700\n")
+            for mask_specs in ([], ["data/mask_position.txt:position"]):
+                with self.assertRaisesRegex(ValueError, "outside the genome of length 600: line 1"):
+                    applymask.main(mask_filepath, "range", "data/test.fasta", "false", "false", mask_specs=mask_specs)
+
+    def test_load_mask_position_aux_malformed(self):
+        data = ["position", "# comment", "3", "3", "1", "x"] + ["2.5"] * 11
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            result = applymask.load_mask_position_aux(data, 10)
+        self.assertEqual(result.positions().tolist(), [1, 3])
+        self.assertEqual(output.getvalue(), "12 malformed masked position lines skipped: line 6, 7, 8, 9, 10, 11, 12, 13, 14, 15 and 2 more\n")
+
+    def test_parse_mask_table_header(self):
+        # only a line of words is a header, a bad first data line is malformed
+        for first_line in ("12.5", "1e3", "0x10", "-"):
+            _, values, _, malformed = applymask.parse_mask_table(f"{first_line}\n3\n", (1,), 1)
+            self.assertEqual((values[:, 0].tolist(), malformed), ([3], [1]))
+        _, values, _, malformed = applymask.parse_mask_table("chrom start end\nchr1\t2\t3\n", (2, 3), 2)
+        self.assertEqual((values.tolist(), malformed), ([[2, 3]], []))
+
+    def test_parse_mask_table_fast(self):
+        text = "chr1\t5\t7\nchr2\t0\t1\nchr1\t9\t9\n\n"
+        labels, values, linenos, malformed = applymask.parse_mask_table_fast(text, 3, 2)
+        self.assertEqual(labels[:, 0].tolist(), ["chr1", "chr2", "chr1"])
+        self.assertEqual(values.tolist(), [[5, 7], [0, 1], [9, 9]])
+        self.assertEqual(linenos.tolist(), [1, 2, 3])
+        self.assertIsNone(applymask.parse_mask_table_fast(text, 2, 2))
+        self.assertIsNone(applymask.parse_mask_table_fast("1\t2\t3\n4", 2, 2))
+        self.assertIsNone(applymask.parse_mask_table_fast("1\t2\n\n3\t4", 2, 2))
+        self.assertIsNone(applymask.parse_mask_table_fast("1\n2.5", 1, 1))
+        # the line by line parser agrees
+        slow_text = "# ranges\n" + text
+        self.assertEqual([table.tolist() for table in applymask.parse_mask_table(slow_text, (2, 3), 2)[:3]],
+                         [labels.tolist(), values.tolist(), (linenos + 1).tolist()])
+
+    def test_mask_from_ranges(self):
+        mask = applymask.Mask.from_ranges([(5,7),(0,0),(6,9),(20,30)], 10)
+        self.assertEqual(list(mask), [(0,1),(5,10)])
+        self.assertEqual(mask.masked_count(), 6)
+        self.assertTrue(0 in mask)
+        self.assertFalse(4 in mask)
+        self.assertEqual(mask.positions().tolist(), [0,5,6,7,8,9])
+
+    def test_mask_algebra(self):
+        mask1 = applymask.Mask.from_ranges([(0,4),(10,14)], 20)
+        mask2 = applymask.Mask.from_ranges([(3,11),(19,19)])
+        self.assertEqual(list(mask1 | mask2), [(0,15),(19,20)])
+        self.assertEqual(list(mask1 & mask2), [(3,5),(10,12)])
+        self.assertEqual(list(mask1 - mask2), [(0,3),(12,15)])
+        self.assertEqual(list(mask1 ^ mask2), [(0,3),(5,10),(12,15),(19,20)])
+        self.assertEqual((mask1 - mask2).length, 20)
+
+    def test_mask_from_positions(self):
+        mask = applymask.Mask.from_positions([3,1,2,2,-1,10], 10)
+        self.assertEqual(list(mask), [(1,4)])
+        self.assertEqual(mask.to_string(), "0111000000")
+
+    def test_apply_mask_intervals(self):
+        mask = applymask.Mask.from_ranges([(0,0),(5,7),(9,9)])
+        result = applymask.apply_mask(mask, "ACGTACGTAC")
+        self.assertEqual(result, "NCGTANNNAN")
+
     def test_load_mask_position_aux(self):
         data = ["0","5", "6", "7", "9"]
-        expected = list("1000011101")
+        expected = "1000011101"
 
         result = applymask.load_mask_position_aux(data, 10)
-        self.assertEqual(result, expected)
+        self.assertEqual(result.to_string(), expected)
 
     def test_load_mask_position_aux_exception(self):
         data = ["a","5", "6", "7", "9"]
@@ -115,6 +240,22 @@ class TestApplyMask(unittest.TestCase):
         result = applymask.get_mask_ranges(data)
         self.assertEqual(result, expected)
 
+    def test_get_mask_ranges_array(self):
+        data = applymask.mask_to_array("1100011101")
+        expected = "\n".join(["0\t1","5\t7", "9\t9"])
+
+        result = applymask.get_mask_ranges(data)
+        self.assertEqual(result, expected)
+
+    def test_get_mask_bed(self):
+        data = applymask.Mask.from_ranges([(0,0),(5,7),(9,9)])
+        expected = "\n".join(["chr\t0\t1","chr\t5\t8", "chr\t9\t10"])
+
+        result = applymask.get_mask_bed(data, "chr")
+        self.assertEqual(result, expected)
+        # record names are written as they are, braces included
+        self.assertEqual(applymask.get_mask_bed(data, "ctg{1}"), expected.replace("chr", "ctg{1}"))
+
     def test_apply_mask(self):
         mask = list("1000011101")
         sequence = list("ACGTACGTAC")
@@ -123,26 +264,33 @@ class TestApplyMask(unittest.TestCase):
         result = applymask.apply_mask(mask, sequence)
         self.assertEqual(result, expected)
 
+    def test_apply_mask_fasta_string(self):
+        result = applymask.apply_mask(self.expected_mask, self.sequence)
+        self.assertEqual(result, self.maskedsequence)
+
+    def test_apply_mask_short_mask(self):
+        self.assertRaises(IndexError, applymask.apply_mask, "10", "ACGT")
+
     def test_load_mask_fasta(self):
         inputfile = "data/mask_fasta.fasta"
         expected = self.expected_mask
 
         result = applymask.load_mask_fasta(inputfile)
-        self.assertEqual(result, expected)
+        self.assertEqual(result.to_string(), expected)
     
     def test_load_mask_position(self):
         inputfile = "data/mask_position.txt"
-        expected = list(self.expected_mask)
+        expected = self.expected_mask
 
         result = applymask.load_mask_positon(inputfile,600)
-        self.assertEqual(result, expected)
+        self.assertEqual(result.to_string(), expected)
 
     def test_load_mask_range(self):
         inputfile = "data/mask_range.tsv"
-        expected = list(self.expected_mask)
+        expected = self.expected_mask
 
         result = applymask.load_mask_range(inputfile,600)
-        self.assertEqual(result, expected)
+        self.assertEqual(result.to_string(), expected)
 
     def test_load_fasta(self):
         assert_fasta(self,"data/test.fasta", self.sequence)
@@ -160,6 +308,18 @@ class TestApplyMask(unittest.TestCase):
         result = applymask.string_insert_newlines(input_str,10)
         self.assertEqual(expected_str, result)
 
+    def test_write_wrapped(self):
+        sequence = "AAAAAAAAAACCCCCCCCCCGGGGGGGGGGTTTTT"
+        for chunk_len, batch_size in ((10, 1 << 20), (10, 15), (7, 3), (35, 10), (60, 100)):
+            expected = applymask.string_insert_newlines(sequence, chunk_len).encode()
+            for data in (sequence, sequence.encode(), memoryview(sequence.encode()), applymask.sequence_to_array(sequence)):
+                f = io.BytesIO()
+                applymask.write_wrapped(f, data, chunk_len, batch_size)
+                self.assertEqual(f.getvalue(), expected)
+        f = io.BytesIO()
+        applymask.write_wrapped(f, "", 60)
+        self.assertEqual(f.getvalue(), b"")
+
     def test_save_fasta(self):
         filepath= "data/saved_fasta.fasta"
         header = ">NC_000962_3"
@@ -186,6 +346,515 @@ class TestApplyMask(unittest.TestCase):
         os.remove(filepath)
         print(f"file {filepath} removed.")
     
+    def test_mask_line(self):
+        mask = applymask.Mask.from_ranges([(0,0),(5,7),(9,9)])
+        self.assertEqual(applymask.mask_line(mask, b"ACGTA\n", 0), b"NCGTA\n")
+        self.assertEqual(applymask.mask_line(mask, b"CGTAC\n", 5), b"NNNAN\n")
+        self.assertEqual(applymask.mask_line(mask, b"ACGTA", 10), b"ACGTA")
+
+    def test_mask_fasta_stream(self):
+        filepath = "data/streamed_fasta.fasta"
+        mask = applymask.load_mask_range("data/mask_range.tsv", None)
+        records = applymask.mask_fasta_stream(mask, "data/test.fasta", filepath, False)
+        self.assertEqual(records, [(self.header, 600)])
+        assert_fasta(self, filepath, self.maskedsequence)
+        os.remove(filepath)
+
+    def test_mask_fasta_stream_gzip(self):
+        filepath = "data/streamed_fasta.fasta.gz"
+        mask = applymask.load_mask_positon("data/mask_position.txt", None)
+        applymask.mask_fasta_stream(mask, "data/test.fasta.gz", filepath, True)
+        assert_fasta_zip(self, filepath, self.maskedsequence)
+        os.remove(filepath)
+
+    def test_main_ranges_nozip_stream(self):
+        fasta_filepath = "data/test.fasta"
+        mask_filepath = "data/mask_range.tsv"
+        output_fasta = "test.masked.fasta"
+        applymask.main(mask_filepath, "range", fasta_filepath, "false", "true", stream=True)
+        assert_fasta(self, output_fasta, self.maskedsequence)
+
+    def test_load_mask_range_aux_contigs(self):
+        data = ["contig_1\t0\t2", "contig_1\t15\t15", "contig_3\t9\t9"]
+        result = applymask.load_mask_range_aux(data, None)
+        self.assertEqual(sorted(result), ["contig_1", "contig_3"])
+        self.assertEqual(list(result["contig_1"]), [(0,3),(15,16)])
+
+    def test_load_mask_bed(self):
+        result = applymask.load_mask_bed("data/mask_bed.bed")
+        expected = applymask.load_mask_range("data/mask_range_contig.tsv", None)
+        self.assertEqual(list(result), ["contig_1", "contig_3"])
+        self.assertEqual(result, expected)
+        with self.assertRaisesRegex(ValueError, "1 masked ranges outside the genome of length 10: line 3"):
+            applymask.load_mask_bed("data/mask_bed.bed", 10)
+
+    def test_load_mask_bed_text(self):
+        result = applymask.load_mask_bed_text("contig_1\t5\t5\ncontig_1\t2\t4\ncontig_2\t0\t1\n", 10)
+        self.assertEqual(list(result["contig_1"]), [(2,4)])
+        self.assertEqual(list(result["contig_2"]), [(0,1)])
+
+    def test_bed_index(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            mask_filepath = os.path.join(dirpath, "mask.bed")
+            cache_dirpath = os.path.join(dirpath, "cache")
+            shutil.copy("data/mask_bed.bed", mask_filepath)
+            expected = applymask.load_mask_bed(mask_filepath)
+            index_filepath = applymask.bed_index_filepath(mask_filepath, cache_dirpath)
+            self.assertFalse(os.path.exists(index_filepath))
+            self.assertEqual(applymask.load_mask_cached(mask_filepath, "bed", cache_dirpath=cache_dirpath), expected)
+            self.assertTrue(os.path.exists(index_filepath))
+            self.assertEqual(sorted(os.listdir(dirpath)), ["cache", "mask.bed"])
+            self.assertEqual(applymask.load_mask_bed(mask_filepath, 20, True, cache_dirpath), expected)
+            with self.assertRaises(ValueError):
+                applymask.load_mask_bed(mask_filepath, 10, True, cache_dirpath)
+            # the index counts towards the cache size and is evicted with it
+            self.assertEqual(len(applymask.mask_cache_info(cache_dirpath)), 1)
+            self.assertEqual(applymask.clear_mask_cache(cache_dirpath), 1)
+            self.assertFalse(os.path.exists(index_filepath))
+
+    def test_bed_index_unwritable_cache(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            # a file where the cache directory should be
+            cache_dirpath = os.path.join(dirpath, "cache")
+            open(cache_dirpath, "w").close()
+            with contextlib.redirect_stderr(io.StringIO()) as output:
+                mask = applymask.load_mask_cached("data/mask_bed.bed", "bed", cache_dirpath=cache_dirpath)
+            self.assertEqual(mask, applymask.load_mask_bed("data/mask_bed.bed"))
+            self.assertRegex(output.getvalue(), "bed index not cached")
+
+    def test_save_mask_bed(self):
+        mask = applymask.load_mask_bed("data/mask_bed.bed")
+        with tempfile.TemporaryDirectory() as dirpath:
+            filepath = os.path.join(dirpath, "mask.bed")
+            applymask.save_mask(mask, filepath, "bed")
+            self.assertEqual(applymask.load_mask(filepath, "bed"), mask)
+            applymask.save_mask(mask["contig_1"], filepath, "bed", chrom="contig_1")
+            with open(filepath) as f:
+                self.assertEqual(f.read(), "contig_1\t0\t3\ncontig_1\t15\t16")
+            with self.assertRaises(ValueError):
+                applymask.save_mask(mask["contig_1"], filepath, "bed")
+
+    def test_mask_queries(self):
+        mask = applymask.Mask.from_ranges([(2,4),(10,11)], 20)
+        self.assertEqual(mask.is_masked([0, 2, 4, 5, 11, 12]).tolist(), [False, True, True, False, True, False])
+        self.assertEqual(mask.masked_overlap([0, 3, 5, 0], [20, 11, 10, 3]).tolist(), [5, 3, 0, 1])
+        self.assertTrue(mask.overlaps(4, 6))
+        self.assertFalse(mask.overlaps(5, 10))
+        for start, end in ((0, 20), (3, 10), (4, 5), (11, 20), (10, 10)):
+            self.assertEqual(mask.window(start, end).tolist(), mask.to_array(20)[start:end].tolist())
+        empty = applymask.Mask([], [], 20)
+        self.assertEqual(empty.masked_overlap(0, 20), 0)
+        self.assertFalse(empty.is_masked(3))
+        self.assertFalse(empty.window(0, 20).any())
+
+    def test_main_bed(self):
+        output_fasta = "test_multi.masked.fasta"
+        applymask.main("data/mask_bed.bed", "bed", "data/test_multi.fasta", "false", "false")
+        records = applymask.load_fasta_records(output_fasta)
+        os.remove(output_fasta)
+        self.assertEqual([seq for _, seq, _ in records], ["NNNAAAAAAACCCCCNCCCC", "G" * 10 + "T" * 10, "ACGTACGTAN"])
+
+    def test_load_fasta_records(self):
+        records = applymask.load_fasta_records("data/test_multi.fasta")
+        self.assertEqual(records, [(">contig_1 first", "A" * 10 + "C" * 10, 10),
+                                   (">contig_2", "G" * 10 + "T" * 10, 10),
+                                   (">contig_3", "ACGTACGTAC", 10)])
+
+    def test_read_fasta_records(self):
+        records = applymask.read_fasta_records("data/test_multi.fasta")
+        self.assertEqual(next(records), (">contig_1 first", "A" * 10 + "C" * 10, 10))
+        self.assertEqual(list(records), applymask.load_fasta_records("data/test_multi.fasta")[1:])
+
+    def test_save_mask(self):
+        mask = applymask.Mask.from_ranges([(1, 2), (5, 5)], 8)
+        with tempfile.TemporaryDirectory() as dirpath:
+            for mask_format in ("fasta", "position", "range"):
+                filepath = os.path.join(dirpath, f"mask.{mask_format}")
+                applymask.save_mask(mask, filepath, mask_format)
+                self.assertEqual(applymask.load_mask(filepath, mask_format, 8), mask)
+            with self.assertRaises(ValueError):
+                applymask.save_mask(mask, filepath, "bam")
+
+    def test_mask_fasta_stream_failure(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            new_fasta_filepath = os.path.join(dirpath, "test.masked.fasta")
+            with self.assertRaises(IndexError):
+                applymask.mask_fasta_stream(applymask.Mask([], [], 100), "data/test.fasta", new_fasta_filepath, False)
+            self.assertEqual(os.listdir(dirpath), [])
+
+    def test_mask_fasta_stream_contigs(self):
+        filepath = "data/streamed_multi.fasta"
+        mask = applymask.load_mask_range("data/mask_range_contig.tsv", None)
+        records = applymask.mask_fasta_stream(mask, "data/test_multi.fasta", filepath, False)
+        self.assertEqual(records, [(">contig_1 first", 20), (">contig_2", 20), (">contig_3", 10)])
+        with open(filepath) as f:
+            self.assertEqual(f.read(), ">contig_1 first\nNNNAAAAAAA\nCCCCCNCCCC\n>contig_2\nGGGGGGGGGG\nTTTTTTTTTT\n>contig_3\nACGTACGTAN\n")
+        os.remove(filepath)
+
+    def test_main_contigs(self):
+        output_fasta = "test_multi.masked.fasta"
+        applymask.main("data/mask_range_contig.tsv", "range", "data/test_multi.fasta", "false", "true")
+        records = applymask.load_fasta_records(output_fasta)
+        self.assertEqual([seq for _, seq, _ in records], ["NNNAAAAAAACCCCCNCCCC", "G" * 10 + "T" * 10, "ACGTACGTAN"])
+        os.remove(output_fasta)
+
+    def test_expand_fasta_filepaths(self):
+        result = applymask.expand_fasta_filepaths(["data/test*.fasta", "data/missing.fasta"])
+        self.assertEqual(result, ["data/test.fasta", "data/test_multi.fasta", "data/missing.fasta"])
+
+    def test_batch_main(self):
+        failures = applymask.batch_main("data/mask_range.tsv", "range", ["data/test.fasta", "data/missing.fasta"], "false", processes=2)
+        self.assertEqual([fasta_filepath for fasta_filepath, _ in failures], ["data/missing.fasta"])
+        assert_fasta(self, "test.masked.fasta", self.maskedsequence)
+
+    def test_batch_main_shared_output(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            fasta_filepaths = [os.path.join(dirpath, sample, "consensus.fasta") for sample in ("d1", "d2")]
+            for fasta_filepath in fasta_filepaths:
+                os.mkdir(os.path.dirname(fasta_filepath))
+                shutil.copy("data/test.fasta", fasta_filepath)
+            failures = applymask.batch_main("data/mask_range.tsv", "range", [os.path.join(dirpath, "*", "consensus.fasta")], "false", processes=2)
+            self.assertEqual([fasta_filepath for fasta_filepath, _ in failures], fasta_filepaths)
+            self.assertRegex(failures[0][1], "consensus.masked.fasta is shared with")
+            self.assertFalse(os.path.exists("consensus.masked.fasta"))
+
+    def test_batch_main_overlapping_patterns(self):
+        self.assertEqual(applymask.expand_fasta_filepaths(["data/test*.fasta", "data/test.fasta", "./data/test.fasta"]),
+                         ["data/test.fasta", "data/test_multi.fasta"])
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            failures = applymask.batch_main("data/mask_position.txt", "position", ["data/test.fasta", "data/t*.fasta"], "false", processes=2)
+        os.remove("test_multi.masked.fasta")
+        self.assertEqual(failures, [])
+        self.assertIn("2 of 2 files masked", output.getvalue())
+
+    def test_load_mask_cached(self):
+        cache_dirpath = tempfile.mkdtemp()
+        try:
+            expected = applymask.load_mask_range("data/mask_range.tsv", 600)
+            result1 = applymask.load_mask_cached("data/mask_range.tsv", "range", 600, cache_dirpath)
+            result2 = applymask.load_mask_cached("data/mask_range.tsv", "range", 600, cache_dirpath)
+            self.assertEqual(result1, expected)
+            self.assertEqual(result2, expected)
+            self.assertEqual(result2.length, 600)
+            self.assertEqual(len(applymask.mask_cache_info(cache_dirpath)), 1)
+            applymask.load_mask_cached("data/mask_position.txt", "position", None, cache_dirpath)
+            self.assertEqual(len(applymask.mask_cache_info(cache_dirpath)), 2)
+            self.assertEqual(applymask.clear_mask_cache(cache_dirpath), 2)
+            self.assertEqual(applymask.mask_cache_info(cache_dirpath), [])
+        finally:
+            shutil.rmtree(cache_dirpath)
+
+    def test_load_mask_cached_unwritable(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            # a file where the cache directory should be
+            cache_dirpath = os.path.join(dirpath, "cache")
+            open(cache_dirpath, "w").close()
+            with contextlib.redirect_stderr(io.StringIO()) as output:
+                mask = applymask.load_mask_cached("data/mask_range.tsv", "range", 600, cache_dirpath)
+            self.assertEqual(mask, applymask.load_mask_range("data/mask_range.tsv", 600))
+            self.assertRegex(output.getvalue(), "mask not cached")
+
+            # a cache hit that can't record its use
+            cache_dirpath = os.path.join(dirpath, "shared")
+            expected = applymask.load_mask_cached("data/mask_range.tsv", "range", 600, cache_dirpath)
+            with unittest.mock.patch("os.utime", side_effect=PermissionError("read-only cache")):
+                self.assertEqual(applymask.load_mask_cached("data/mask_range.tsv", "range", 600, cache_dirpath), expected)
+
+    def test_evict_mask_cache(self):
+        cache_dirpath = tempfile.mkdtemp()
+        try:
+            applymask.load_mask_cached("data/mask_range.tsv", "range", 600, cache_dirpath)
+            os.utime(os.path.join(cache_dirpath, applymask.mask_cache_info(cache_dirpath)[0][0] + ".npy"), (0, 0))
+            applymask.load_mask_cached("data/mask_fasta.fasta", "fasta", None, cache_dirpath)
+            newest_key, newest_size, _ = applymask.mask_cache_info(cache_dirpath)[0]
+            self.assertEqual(applymask.evict_mask_cache(newest_size, cache_dirpath), 1)
+            self.assertEqual([key for key, _, _ in applymask.mask_cache_info(cache_dirpath)], [newest_key])
+        finally:
+            shutil.rmtree(cache_dirpath)
+
+    def test_patch_fasta_inplace(self):
+        filepath = "data/patched_fasta.fasta"
+        mask = applymask.load_mask_fasta("data/mask_fasta.fasta")
+        records = applymask.patch_fasta_inplace(mask, "data/test.fasta", filepath)
+        self.assertEqual(records, [(self.header, 600)])
+        assert_fasta(self, filepath, self.maskedsequence)
+        os.remove(filepath)
+
+    def test_patch_fasta_inplace_irregular(self):
+        filepath = "data/patched_multi.fasta"
+        mask = applymask.Mask.from_positions([25])
+        self.assertRaises(ValueError, applymask.patch_fasta_inplace, mask, "data/test_multi.fasta", filepath)
+        self.assertFalse(os.path.exists(filepath))
+        # the error names the input, not the copy being patched
+        with tempfile.TemporaryDirectory() as dirpath:
+            fasta_filepath = os.path.join(dirpath, "irregular.fasta")
+            with open(fasta_filepath, "wb") as f:
+                f.write(b">a\nAAAAA\nAAA\nAAAAA\n")
+            filepath = os.path.join(dirpath, "irregular.masked.fasta")
+            with self.assertRaisesRegex(ValueError, f"^{re.escape(fasta_filepath)} is not a single record fasta wrapped at 5 bases"):
+                applymask.patch_fasta_inplace(applymask.Mask.from_positions([6]), fasta_filepath, filepath)
+            self.assertEqual(os.listdir(dirpath), ["irregular.fasta"])
+
+    def test_patch_fasta_inplace_multi_record(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            fasta_filepath = os.path.join(dirpath, "multi.fasta")
+            data = b">a\nAAAAAAAAAA\nCCCCCCCCCC\n>contig_02\nGGGGGGGGGG\n"
+            with open(fasta_filepath, "wb") as f:
+                f.write(data)
+            # every touched line ends where a fixed width layout says it does
+            mask = applymask.Mask.from_positions([3, 20, 21, 22])
+            with self.assertRaisesRegex(ValueError, "more than one record"):
+                applymask.patch_fasta_inplace(mask, fasta_filepath)
+            with open(fasta_filepath, "rb") as f:
+                self.assertEqual(f.read(), data)
+            filepath = os.path.join(dirpath, "multi.masked.fasta")
+            with self.assertRaisesRegex(ValueError, "more than one record"):
+                applymask.patch_fasta_inplace(applymask.load_mask("data/mask_range_contig.tsv", "range"), "data/test_multi.fasta", filepath)
+            self.assertEqual(os.listdir(dirpath), ["multi.fasta"])
+
+    def test_fasta_layout(self):
+        data = b">h\r\nACGT\r\nACGT\r\nAC\r\n"
+        self.assertEqual(applymask.fasta_layout(data), (">h", 4, 4, 2, 10))
+        self.assertEqual(applymask.fasta_layout(b">h\nACGT\nACGT"), (">h", 3, 4, 1, 8))
+
+    def test_remask_fasta_inplace(self):
+        header, sequence, _ = applymask.load_fasta("data/test.fasta")
+        mask_a = applymask.Mask.from_ranges([(0,9),(100,119)], len(sequence))
+        mask_b = applymask.Mask.from_ranges([(5,14),(200,200)], len(sequence))
+        with tempfile.TemporaryDirectory() as dirpath:
+            # the source and the masked fasta may be wrapped differently
+            source_filepath = os.path.join(dirpath, "source.fasta")
+            applymask.save_fasta(source_filepath, header, sequence, 70)
+            fasta_filepath = os.path.join(dirpath, "masked.fasta")
+            applymask.save_fasta(fasta_filepath, header, applymask.apply_mask(mask_a, sequence), 60)
+            changes = applymask.remask_fasta(mask_a, mask_b, fasta_filepath, source_filepath)
+            self.assertEqual(changes, [(header, 6, 25)])
+            self.assertEqual(applymask.load_fasta(fasta_filepath), (header, applymask.apply_mask(mask_b, sequence), 60))
+            # masked with neither mask
+            applymask.save_fasta(fasta_filepath, header, sequence, 60)
+            with self.assertRaisesRegex(ValueError, "has 25 unmasked bases where the previous mask masks"):
+                applymask.remask_fasta(mask_a, mask_b, fasta_filepath, source_filepath)
+
+    def test_remask_fasta_inplace_irregular(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            source_filepath = os.path.join(dirpath, "source.fasta")
+            with open(source_filepath, "w") as f:
+                f.write(">a\nACGTA\nCGTAC\nGTACGTA\n")
+            # the third line is longer than the others
+            fasta_filepath = os.path.join(dirpath, "masked.fasta")
+            data = b">a\nNCGTA\nCGTAC\nGTACGTA\n"
+            with open(fasta_filepath, "wb") as f:
+                f.write(data)
+            with self.assertRaisesRegex(ValueError, "wrapped at 5 bases"):
+                applymask.remask_fasta(applymask.Mask.from_positions([0]), applymask.Mask.from_positions([12]), fasta_filepath, source_filepath)
+            with open(fasta_filepath, "rb") as f:
+                self.assertEqual(f.read(), data)
+
+    def test_remask_fasta_outside_record(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            mask_filepath = os.path.join(dirpath, "mask.tsv")
+            with open(mask_filepath, "w") as f:
+                f.write("8\t20\n")
+            mask = applymask.load_mask(mask_filepath, "range")
+            previous_mask = applymask.Mask([], [])
+            for use_gzip in (False, True):
+                fasta_filepath = os.path.join(dirpath, "masked.fasta" + (".gz" if use_gzip else ""))
+                applymask.save_fasta_records(fasta_filepath, [(">a", "ACGTACGTAC", 5)], use_gzip)
+                with self.assertRaisesRegex(ValueError, "outside the genome of length 10: line 1"):
+                    applymask.remask_fasta(previous_mask, mask, fasta_filepath, "data/test_multi.fasta", use_gzip)
+
+    def test_remask_fasta_records(self):
+        records = applymask.load_fasta_records("data/test_multi.fasta")
+        mask_a = applymask.load_mask_range("data/mask_range_contig.tsv", None)
+        mask_b = {"contig_2": applymask.Mask.from_ranges([(0,1)]), "contig_3": applymask.Mask.from_ranges([(9,9)])}
+        with tempfile.TemporaryDirectory() as dirpath:
+            fasta_filepath = os.path.join(dirpath, "masked.fasta.gz")
+            masked_records = [(header, applymask.apply_mask(mask_a[header[1:9]], sequence) if header[1:9] in mask_a else sequence, chunk_len)
+                              for header, sequence, chunk_len in records]
+            applymask.save_fasta_records(fasta_filepath, masked_records, use_gzip=True)
+            changes = applymask.remask_fasta(mask_a, mask_b, fasta_filepath, "data/test_multi.fasta", use_gzip=True)
+            self.assertEqual(changes, [(">contig_1 first", 0, 4), (">contig_2", 2, 0), (">contig_3", 0, 0)])
+            self.assertEqual([sequence for _, sequence, _ in applymask.load_fasta_records(fasta_filepath, True)],
+                             [records[0][1], "NN" + "G" * 8 + "T" * 10, "ACGTACGTAN"])
+
+            # a failed write leaves the masked fasta as it was and no temporary file
+            def save_partial(filepath, records, use_gzip):
+                with open(filepath, "wb") as f:
+                    f.write(b">contig_1")
+                raise OSError("disk full")
+            with unittest.mock.patch("applymask.save_fasta_records", side_effect=save_partial):
+                self.assertRaises(OSError, applymask.remask_fasta, mask_b, mask_a, fasta_filepath, "data/test_multi.fasta", use_gzip=True)
+            self.assertEqual(os.listdir(dirpath), ["masked.fasta.gz"])
+
+    def test_remask_main_manifest(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            fasta_filepath = os.path.join(dirpath, "test.fasta")
+            shutil.copy("data/test.fasta", fasta_filepath)
+            applymask.main("data/mask_position.txt", "position", fasta_filepath, "false", "false", manifest=True)
+            masked_filepath = applymask.masked_fasta_filepath(fasta_filepath, False)
+            manifest = applymask.read_manifest(masked_filepath)
+            self.assertEqual(manifest["mask"]["format"], "position")
+            self.assertEqual(manifest["source"], os.path.abspath(fasta_filepath))
+
+            changes = applymask.remask_main("data/mask_range.tsv", "range", masked_filepath, "false", fasta_filepath)
+            self.assertEqual(changes[0][0], self.header)
+            self.assertEqual(applymask.load_fasta(masked_filepath)[1], self.maskedsequence)
+            self.assertEqual(applymask.read_manifest(masked_filepath)["mask"], applymask.mask_version("data/mask_range.tsv", "range"))
+
+            # back to the position mask, naming the previous mask explicitly
+            os.remove(applymask.manifest_filepath(masked_filepath))
+            with self.assertRaisesRegex(ValueError, "has no manifest"):
+                applymask.remask_main("data/mask_position.txt", "position", masked_filepath, "false", fasta_filepath)
+            applymask.remask_main("data/mask_position.txt", "position", masked_filepath, "false", fasta_filepath, "data/mask_range.tsv:range")
+            self.assertEqual(applymask.load_fasta(masked_filepath)[1], self.maskedsequence)
+
+    def test_compose_masks(self):
+        mask1 = applymask.Mask.from_ranges([(0,4),(10,14)], 20)
+        mask2 = applymask.Mask.from_ranges([(3,11)], 20)
+        mask3 = applymask.Mask.from_ranges([(0,0)], 20)
+        self.assertEqual(list(applymask.compose_masks([mask1, mask2, mask3])), [(0,15)])
+        self.assertEqual(list(applymask.compose_masks([mask1, mask2], "intersection")), [(3,5),(10,12)])
+        self.assertEqual(list(applymask.compose_masks([mask1, mask2, mask3], "difference")), [(1,3),(12,15)])
+        self.assertIs(applymask.compose_masks([mask1]), mask1)
+        with self.assertRaises(ValueError):
+            applymask.compose_masks([mask1, mask2], "xor")
+
+    def test_compose_masks_contigs(self):
+        contig_masks = {"contig_1": applymask.Mask.from_ranges([(0,2)])}
+        mask = applymask.Mask.from_ranges([(5,5)])
+        union = applymask.compose_masks([contig_masks, mask])
+        self.assertEqual(list(applymask.mask_for_record(union, ">contig_1 first")), [(0,3),(5,6)])
+        self.assertEqual(list(applymask.mask_for_record(union, ">contig_2")), [(5,6)])
+        intersection = applymask.compose_masks([contig_masks, mask], "intersection")
+        self.assertEqual(list(applymask.mask_for_record(intersection, ">contig_1")), [])
+        self.assertIsNone(applymask.mask_for_record(intersection, ">contig_2"))
+        difference = applymask.compose_masks([contig_masks, mask], "difference")
+        self.assertIsNone(applymask.mask_for_record(difference, ">contig_2"))
+
+    def test_mask_contributions(self):
+        masks = [applymask.Mask.from_ranges([(0,4)]), {"contig_1": applymask.Mask.from_ranges([(3,7)])}]
+        records = [(">contig_1", 20), (">contig_2", 20)]
+        self.assertEqual(applymask.mask_contributions(masks, records), [(10, 8), (5, 3)])
+        self.assertEqual(applymask.mask_contributions(masks, records, "intersection"), [(10, 3), (5, 3)])
+        self.assertEqual(applymask.mask_contributions(masks, records, "difference"), [(10, 8), (5, 2)])
+
+    def test_main_mask_specs(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            applymask.main("data/mask_position.txt", "position", "data/test.fasta", "false", "false",
+                           mask_specs=["data/mask_fasta.fasta:fasta", "data/mask_range.tsv:range"])
+        assert_fasta(self, "test.masked.fasta", self.maskedsequence)
+        self.assertIn("data/mask_position.txt:position\t10\t0\n", output.getvalue())
+        applymask.main("data/mask_position.txt", "position", "data/test.fasta", "false", "false",
+                       mask_specs=["data/mask_range.tsv:range"], combine="difference")
+        assert_fasta(self, "test.masked.fasta", self.sequence)
+
+    def test_parallel_gzip_writer(self):
+        filepath = "data/parallel.fasta.gz"
+        data = b"".join(b"%08d\n" % i for i in range(1000))
+        with applymask.ParallelGzipWriter(filepath, compresslevel=1, threads=2, block_size=1000) as f:
+            f.write(data[:2500])
+            f.writelines([data[2500:5000], data[5000:]])
+        with gzip.open(filepath, "rb") as f:
+            self.assertEqual(f.read(), data)
+        os.remove(filepath)
+
+    def test_save_fasta_gzip_threads(self):
+        filepath = "data/saved_fasta_threads.fasta.gz"
+        applymask.save_fasta_gzip(filepath, self.header, self.sequence, self.chunklen, compresslevel=1, threads=2)
+        assert_fasta_zip(self, filepath, self.sequence)
+        os.remove(filepath)
+
+    def test_mask_fasta_pipeline(self):
+        filepath = "data/pipelined_fasta.fasta.gz"
+        mask = applymask.load_mask_range("data/mask_range.tsv", None)
+        records = applymask.mask_fasta_pipeline(mask, "data/test.fasta.gz", filepath, True, chunk_size=100, queue_depth=2)
+        self.assertEqual(records, [(self.header, 600)])
+        assert_fasta_zip(self, filepath, self.maskedsequence)
+        os.remove(filepath)
+
+    def test_mask_fasta_pipeline_error(self):
+        filepath = "data/pipelined_fasta.fasta"
+        mask = applymask.Mask.from_positions([0], 10)
+        self.assertRaises(IndexError, applymask.mask_fasta_pipeline, mask, "data/test.fasta", filepath, False, chunk_size=100, queue_depth=1)
+        self.assertFalse(os.path.exists(filepath))
+        # a decode error leaves no partial output either
+        filepath = "data/pipelined_fasta.masked.gz"
+        self.assertRaises(gzip.BadGzipFile, applymask.mask_fasta_pipeline, applymask.Mask([], [], 600), "data/test.fasta", filepath, True)
+        self.assertFalse(os.path.exists(filepath))
+
+    def test_masker_mask_sequence(self):
+        masker = applymask.Masker.from_file("data/mask_position.txt", "position")
+        self.assertEqual(masker.mask_sequence(self.sequence), self.maskedsequence)
+        self.assertEqual(masker.mask_sequence(self.sequence.encode()), self.maskedsequence.encode())
+        buf = bytearray(self.sequence.encode())
+        self.assertIs(masker.mask_sequence(buf), buf)
+        self.assertEqual(buf, self.maskedsequence.encode())
+        buf = bytearray(self.sequence.encode())
+        masker.mask_sequence(memoryview(buf)[60:120])
+        self.assertEqual(buf[60:120], self.maskedsequence[60:120].encode())
+        self.assertEqual(masker.mask_sequence(memoryview(self.sequence.encode())), self.maskedsequence.encode())
+        # the expanded mask is built once per sequence length
+        with unittest.mock.patch.object(applymask.Mask, "to_array", side_effect=AssertionError("not cached")):
+            self.assertEqual(masker.mask_sequence(self.sequence), self.maskedsequence)
+        self.assertEqual(masker.mask_sequence(self.sequence[:100]), self.maskedsequence[:100])
+        self.assertEqual(len(masker.arrays), 3)
+
+    def test_masker_contigs(self):
+        masker = applymask.Masker.from_file("data/mask_range_contig.tsv", "range")
+        self.assertEqual(masker.mask_sequence("ACGTACGTAC", ">contig_3"), "ACGTACGTAN")
+        self.assertEqual(masker.mask_sequence("ACGTACGTAC", ">contig_2"), "ACGTACGTAC")
+        self.assertRaises(ValueError, masker.mask_sequence, "ACGTACGTAC")
+
+    def test_masker_mask_stream(self):
+        masker = applymask.Masker.from_file("data/mask_range.tsv", "range")
+        f_out = io.BytesIO()
+        with open("data/test.fasta", "rb") as f_in:
+            records = masker.mask_stream(f_in, f_out)
+        self.assertEqual(records, [(self.header, 600)])
+        header, seq, chunklen = applymask.parse_fasta_records(f_out.getvalue().decode().split("\n"))[0]
+        self.assertEqual(seq, self.maskedsequence)
+        # the last record is checked once the stream ends
+        with open("data/test.fasta", "rb") as f_in:
+            f_in = io.BytesIO(f_in.read()[:-400])
+        with self.assertRaisesRegex(ValueError, "outside the genome of length"):
+            masker.mask_stream(f_in, io.BytesIO())
+
+    def test_masker_mask_file(self):
+        filepath = "data/masker_fasta.fasta.gz"
+        masker = applymask.Masker.from_file("data/mask_fasta.fasta", "fasta")
+        masker.mask_file("data/test.fasta.gz", filepath, True, stream=True)
+        assert_fasta_zip(self, filepath, self.maskedsequence)
+        os.remove(filepath)
+
+    def test_instrumentation(self):
+        instrumentation = applymask.Instrumentation(fasta="data/test.fasta")
+        masker = applymask.Masker.from_file("data/mask_range.tsv", "range")
+        filepath = "data/instrumented.fasta"
+        masker.mask_file("data/test.fasta", filepath, instrumentation=instrumentation)
+        record = instrumentation.record()
+        self.assertEqual(record["fasta"], "data/test.fasta")
+        self.assertEqual([stage["stage"] for stage in record["stages"]], ["load_fasta", "apply_mask", "write_fasta"])
+        self.assertEqual(record["stages"][0]["bytes_read"], os.path.getsize("data/test.fasta"))
+        self.assertEqual(record["total"]["bytes_written"], os.path.getsize(filepath))
+        self.assertGreater(record["total"]["max_rss_bytes"], 0)
+        for stage in record["stages"]:
+            self.assertLessEqual(stage["max_rss_bytes"], record["total"]["max_rss_bytes"])
+            self.assertGreaterEqual(stage["max_rss_growth_bytes"], 0)
+        os.remove(filepath)
+
+    def test_main_metrics(self):
+        metrics_filepath = "data/metrics.jsonl"
+        applymask.main("data/mask_range.tsv", "range", "data/test.fasta.gz", "true", "true", metrics=metrics_filepath, stream=True)
+        applymask.main("data/mask_range.tsv", "range", "data/test.fasta.gz", "true", "false", metrics=metrics_filepath)
+        with open(metrics_filepath) as f:
+            records = [json.loads(line) for line in f]
+        os.remove(metrics_filepath)
+        self.assertEqual([stage["stage"] for stage in records[0]["stages"]], ["load_mask", "stream", "print_ranges"])
+        self.assertEqual([stage["stage"] for stage in records[1]["stages"]], ["load_mask", "load_fasta", "apply_mask", "write_fasta"])
+        self.assertEqual(records[1]["mask_format"], "range")
+
     def test_main_fasta_nozip(self):
         fasta_filepath = "data/test.fasta"
         mask_filepath = "data/mask_fasta.fasta"
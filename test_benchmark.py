@@ -0,0 +1,41 @@
+# Test benchmark.py
+# Run all tests: python3 test_benchmark.py
+# Run code coverage: coverage run test_benchmark.py
+
+import shutil
+import tempfile
+import unittest
+import applymask
+import benchmark
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def test_write_fixtures(self):
+        fixtures = benchmark.write_fixtures(self.dirpath, 10000)
+        records = applymask.load_fasta_records(fixtures["multi"])
+        self.assertEqual(len(records), benchmark.CONTIGS)
+        masks = [applymask.load_mask(fixtures[f"{mask_format}_dense"], mask_format, 10000) for mask_format in ("fasta", "position", "range")]
+        self.assertEqual(masks[0], masks[1])
+        self.assertEqual(masks[0], masks[2])
+
+    def test_run_benchmarks(self):
+        results = benchmark.run_benchmarks(self.dirpath, 10000)
+        self.assertIn("apply_mask_dense", results)
+        self.assertIn("save_fasta_gzip", results)
+        self.assertGreater(results["load_fasta"]["peak_bytes"], 0)
+
+    def test_find_regressions(self):
+        baseline = {"apply": {"seconds": 1.0, "peak_bytes": 100}, "write": {"seconds": 1.0, "peak_bytes": 100}}
+        results = {"apply": {"seconds": 1.2, "peak_bytes": 100}, "write": {"seconds": 2.0, "peak_bytes": 200}, "new": {"seconds": 1.0, "peak_bytes": 1}}
+        regressions = benchmark.find_regressions(results, baseline, 0.5)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(all(regression.startswith("write") for regression in regressions))
+
+
+if __name__ == "__main__":
+    unittest.main()
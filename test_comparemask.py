@@ -6,6 +6,7 @@
 
 import os
 import unittest
+import applymask
 import comparemask
 
 def assert_mask(self, mask_name):
@@ -38,6 +39,27 @@ class TestCompareMask(unittest.TestCase):
         result = comparemask.fasta_to_posistions("data/mask_fasta.fasta")
         self.assertEqual(expected, result)
 
+    def test_compare_masks(self):
+        mask1 = comparemask.load_mask("data/mask_fasta.fasta", "fasta")
+        mask2 = comparemask.load_mask("data/mask_range.tsv", "range", 600)
+        mask2 = mask2 | applymask.Mask.from_ranges([(400,409)])
+        result = comparemask.compare_masks(mask1, mask2)
+        self.assertEqual(result["mask1"], 10)
+        self.assertEqual(result["mask2"], 20)
+        self.assertEqual(result["both"], 10)
+        self.assertEqual(result["union"], 20)
+        self.assertEqual(list(result["only1"]), [])
+        self.assertEqual(list(result["only2"]), [(400,410)])
+
+    def test_load_mask_unknown_format(self):
+        self.assertRaises(ValueError, comparemask.load_mask, "data/mask_range.tsv", "something")
+
+    def test_main_contigs(self):
+        result = comparemask.main("data/mask_range_contig.tsv", "range", "data/mask_position.txt", "position", 20, True)
+        self.assertEqual(sorted(result), ["contig_1", "contig_3"])
+        self.assertEqual(list(result["contig_1"]["only1"]), [(1,3),(15,16)])
+        self.assertEqual(list(result["contig_3"]["only2"]), [(0,1)])
+
     def test_write_position_to_file(self):
         expected = self.expected_mask_strings
         result = comparemask.write_position_to_file(self.expected_mask_positions, 'data/output_positions.txt')
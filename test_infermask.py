@@ -0,0 +1,74 @@
+# Test infermask.py
+# Run all tests: python3 test_infermask.py
+# Run code coverage: coverage run test_infermask.py
+
+import os
+import tempfile
+import unittest
+import applymask
+import infermask
+
+class TestInferMask(unittest.TestCase):
+    def setUp(self):
+        self.reference = "ACGTACGTAC"
+        self.samples = [
+            "ACGTACGTAC",
+            "ACNTACGTAC",
+            "ACNTATGTAC",
+            "ACNTAGGTAN",
+            "TCGTACGTAC",
+        ]
+
+    def test_site_counts(self):
+        counts = infermask.infer_mask(self.reference, self.samples)
+        self.assertEqual(counts.samples, 5)
+        self.assertEqual(counts.unknown_counts.tolist(), [0, 0, 3, 0, 0, 0, 0, 0, 0, 1])
+        self.assertEqual(counts.allele_counts[:, 5].tolist(), [0, 3, 1, 1])
+
+    def test_masks(self):
+        masks = infermask.infer_mask(self.reference, self.samples).masks()
+        self.assertEqual(masks["reference"].positions().tolist(), [])
+        # N in 3 of 5 samples
+        self.assertEqual(masks["n"].positions().tolist(), [2])
+        # two alt alleles, T and G, at position 5, a single alt at position 0
+        self.assertEqual(masks["multiallelic"].positions().tolist(), [5])
+
+    def test_thresholds(self):
+        counts = infermask.infer_mask(self.reference, self.samples)
+        self.assertEqual(counts.mask(n_fraction=0.2).positions().tolist(), [2, 5, 9])
+        self.assertEqual(counts.mask(min_allele_count=2).positions().tolist(), [2])
+
+    def test_unknown_reference(self):
+        counts = infermask.infer_mask("ACNT", ["ACGT", "ACTT"])
+        self.assertEqual(counts.mask().positions().tolist(), [2])
+
+    def test_skip_wrong_length(self):
+        counts = infermask.infer_mask(self.reference, self.samples + ["ACGT"])
+        self.assertEqual(counts.samples, 5)
+
+    # the toy simulation of test/detect_mask.py, 1-snp variants of a reference
+    # plus a second alt allele at the masked positions
+    def test_single_snp_variants(self):
+        reference = 'A' * 10
+        samples = [reference[:i] + 'C' + reference[i + 1:] for i in range(10)]
+        samples += [reference[:i] + 'G' + reference[i + 1:] for i in (2, 5)]
+        self.assertEqual(infermask.infer_mask(reference, samples).mask().positions().tolist(), [2, 5])
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            reference_filepath = os.path.join(dirpath, "reference.fasta")
+            applymask.save_fasta(reference_filepath, ">reference", self.reference, 60)
+            fasta_filepath = os.path.join(dirpath, "samples.fasta.gz")
+            records = [(f">sample_{i}", sample, 4) for i, sample in enumerate(self.samples)]
+            applymask.save_fasta_records(fasta_filepath, records, use_gzip=True)
+            output_filepath = os.path.join(dirpath, "inferred.tsv")
+            mask = infermask.main(reference_filepath, [fasta_filepath], output_filepath, "range")
+            self.assertEqual(mask.positions().tolist(), [2, 5])
+            self.assertEqual(applymask.load_mask(output_filepath, "range", 10), mask)
+            infermask.main(reference_filepath, [fasta_filepath], output_filepath, "position")
+            self.assertEqual(applymask.load_mask(output_filepath, "position", 10), mask)
+            infermask.main(reference_filepath, [fasta_filepath], output_filepath, "bed")
+            self.assertEqual(applymask.load_mask(output_filepath, "bed", 10), {"reference": mask})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# Test maskalignment.py
+# Run all tests: python3 test_maskalignment.py
+# Run code coverage: coverage run test_maskalignment.py
+
+import os
+import tempfile
+import unittest
+import numpy as np
+import applymask
+import maskalignment
+
+class TestMaskAlignment(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.records = [
+            (">sample_1", "ACGTACGTACGT", 5),
+            (">sample_2", "ACGTTCGTACGA", 5),
+            (">sample_3", "ACNTACGAACGT", 5),
+        ]
+        self.fasta_filepath = os.path.join(self.dirpath, "aln.fasta.gz")
+        applymask.save_fasta_records(self.fasta_filepath, self.records, use_gzip=True)
+        self.mask = applymask.Mask.from_ranges([(0, 1), (11, 11)], 12)
+
+    def tearDown(self):
+        for filename in os.listdir(self.dirpath):
+            os.remove(os.path.join(self.dirpath, filename))
+        os.rmdir(self.dirpath)
+
+    def test_load_alignment(self):
+        headers, alignment, chunk_len = maskalignment.load_alignment(self.fasta_filepath, True)
+        self.assertEqual(headers, [header for header, _, _ in self.records])
+        self.assertEqual(alignment.shape, (3, 12))
+        self.assertEqual(chunk_len, 5)
+        self.assertFalse(isinstance(alignment, np.memmap))
+        self.assertEqual(alignment[1].tobytes(), b"ACGTTCGTACGA")
+
+    def test_load_alignment_memmap(self):
+        headers, alignment, _ = maskalignment.load_alignment(self.fasta_filepath, True, memory_limit=20, tmp_dirpath=self.dirpath)
+        self.assertTrue(isinstance(alignment, np.memmap))
+        self.assertEqual([row.tobytes().decode() for row in alignment], [sequence for _, sequence, _ in self.records])
+        maskalignment.mask_alignment(self.mask, alignment)
+        self.assertEqual(alignment[2].tobytes(), b"NNNTACGAACGN")
+
+    def test_load_alignment_lengths(self):
+        fasta_filepath = os.path.join(self.dirpath, "ragged.fasta")
+        applymask.save_fasta_records(fasta_filepath, [(">a", "ACGT", 60), (">b", "ACG", 60)])
+        with self.assertRaisesRegex(ValueError, ">b has length 3, expected 4"):
+            maskalignment.load_alignment(fasta_filepath)
+
+    def test_mask_alignment(self):
+        _, alignment, _ = maskalignment.load_alignment(self.fasta_filepath, True)
+        maskalignment.mask_alignment(self.mask, alignment)
+        self.assertEqual([row.tobytes() for row in alignment], [b"NNGTACGTACGN", b"NNGTTCGTACGN", b"NNNTACGAACGN"])
+
+    def test_variable_columns(self):
+        _, alignment, _ = maskalignment.load_alignment(self.fasta_filepath, True)
+        self.assertEqual(np.flatnonzero(maskalignment.variable_columns(alignment)).tolist(), [4, 7, 11])
+
+    def test_main(self):
+        output_filepath = os.path.join(self.dirpath, "masked.fasta")
+        mask_filepath = os.path.join(self.dirpath, "mask.tsv")
+        applymask.save_mask(self.mask, mask_filepath, "range")
+        maskalignment.main(mask_filepath, "range", self.fasta_filepath, output_filepath)
+        with open(output_filepath) as f:
+            self.assertEqual(f.read(), ">sample_1\nNNGTA\nCGTAC\nGN\n>sample_2\nNNGTT\nCGTAC\nGN\n>sample_3\nNNNTA\nCGAAC\nGN")
+
+        _, columns = maskalignment.main(mask_filepath, "range", self.fasta_filepath, output_filepath, drop_masked=True)
+        self.assertEqual(columns.tolist(), list(range(2, 11)))
+        self.assertEqual([sequence for _, sequence, _ in applymask.load_fasta_records(output_filepath)],
+                         ["GTACGTACG", "GTTCGTACG", "NTACGAACG"])
+
+        columns_filepath = os.path.join(self.dirpath, "columns.txt")
+        output_filepath = os.path.join(self.dirpath, "snps.fasta.gz")
+        maskalignment.main(mask_filepath, "range", self.fasta_filepath, output_filepath, snps_only=True, columns_filepath=columns_filepath)
+        self.assertEqual([sequence for _, sequence, _ in applymask.load_fasta_records(output_filepath, True)], ["AT", "TT", "AA"])
+        self.assertEqual(applymask.load_mask(columns_filepath, "position").positions().tolist(), [4, 7])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# Test maskserver.py
+# Run all tests: python3 test_maskserver.py
+# Run code coverage: coverage run test_maskserver.py
+
+import os
+import tempfile
+import threading
+import unittest
+import applymask
+import maskserver
+
+class TestMaskServer(unittest.TestCase):
+    def setUp(self):
+        self.socket_path = os.path.join(tempfile.mkdtemp(), "applymask.sock")
+        masks = dict([maskserver.load_named_mask("range=data/mask_range.tsv:range")])
+        self.server = maskserver.MaskServer(self.socket_path, masks)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        os.rmdir(os.path.dirname(self.socket_path))
+
+    def test_load_named_mask(self):
+        name, masker = maskserver.load_named_mask("tb=data/mask_position.txt:position")
+        self.assertEqual(name, "tb")
+        self.assertEqual(masker.mask.masked_count(), 10)
+        self.assertRaises(ValueError, maskserver.load_named_mask, "data/mask_position.txt:position")
+
+    def test_mask_request(self):
+        output = "data/served.fasta"
+        request = {"mask": "range", "input": "data/test.fasta", "output": output, "gzip": False, "stream": True}
+        response = maskserver.send_request(self.socket_path, request)
+        self.assertTrue(response["ok"])
+        self.assertEqual(response["records"], [[">NC_000962_3", 600]])
+        _, seq, _ = applymask.load_fasta(output)
+        self.assertEqual(seq[:60], "N" + seq[1:59] + "N")
+        os.remove(output)
+
+    def test_errors_and_metrics(self):
+        response = maskserver.send_request(self.socket_path, {"mask": "missing", "input": "data/test.fasta"})
+        self.assertFalse(response["ok"])
+        self.assertIn("unknown mask", response["error"])
+        # valid json that isn't an object
+        for request in ([1], "x"):
+            response = maskserver.send_request(self.socket_path, request)
+            self.assertFalse(response["ok"])
+            self.assertIn("expected a json object", response["error"])
+        metrics = maskserver.send_request(self.socket_path, {"command": "metrics"})
+        self.assertEqual(metrics["masks"], ["range"])
+        self.assertEqual(metrics["requests"], 3)
+        self.assertEqual(metrics["errors"], 3)
+        self.assertEqual(sum(metrics["latency_buckets"].values()), 3)
+
+    def test_metrics_buckets(self):
+        metrics = maskserver.Metrics()
+        metrics.record(0.005, True)
+        metrics.record(0.2, True)
+        metrics.record(100, False)
+        buckets = metrics.snapshot()["latency_buckets"]
+        self.assertEqual(buckets["0.01"], 1)
+        self.assertEqual(buckets["0.5"], 1)
+        self.assertEqual(buckets["inf"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
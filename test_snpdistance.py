@@ -0,0 +1,65 @@
+# Test snpdistance.py
+# Run all tests: python3 test_snpdistance.py
+# Run code coverage: coverage run test_snpdistance.py
+
+import random
+import unittest
+import numpy as np
+import applymask
+import snpdistance
+
+def brute_force(sequences, masked_positions):
+    samples = len(sequences)
+    matrix = np.zeros((samples, samples), dtype=np.int64)
+    for i in range(samples):
+        for j in range(samples):
+            matrix[i, j] = sum(1 for k, (x, y) in enumerate(zip(sequences[i], sequences[j]))
+                               if x != y and x in "ACGT" and y in "ACGT" and k not in masked_positions)
+    return matrix
+
+class TestSnpDistance(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(1)
+        ref = [rng.choice("ACGT") for _ in range(200)]
+        self.sequences = list()
+        for _ in range(12):
+            seq = list(ref)
+            for _ in range(rng.randint(0, 15)):
+                seq[rng.randrange(200)] = rng.choice("ACGTN-")
+            self.sequences.append("".join(seq))
+        self.masked_positions = set(rng.sample(range(200), 40))
+        self.mask = applymask.Mask.from_positions(sorted(self.masked_positions), 200)
+
+    def test_encode_sequences(self):
+        result = snpdistance.encode_sequences(["ACGTN", b"acgt-"])
+        self.assertEqual(result.tolist(), [[0,1,2,3,4], [0,1,2,3,4]])
+        self.assertRaises(ValueError, snpdistance.encode_sequences, ["ACGT", "ACG"])
+
+    def test_informative_columns(self):
+        encoded = snpdistance.encode_sequences(["AACGN", "ATCGA", "AACTA"])
+        result = snpdistance.informative_columns(encoded, applymask.Mask.from_positions([3]))
+        self.assertEqual(result.tolist(), [[0], [3], [0]])
+
+    def test_block_pairs(self):
+        rows, cols = snpdistance.block_pairs(1, 3, 4)
+        self.assertEqual(list(zip(rows.tolist(), cols.tolist())), [(1,2),(1,3),(2,3)])
+
+    def test_snp_distances(self):
+        expected = brute_force(self.sequences, self.masked_positions)
+        result = snpdistance.snp_distances(self.sequences, self.mask, block_rows=5)
+        self.assertEqual(result.tolist(), expected.tolist())
+
+    def test_snp_distances_no_mask(self):
+        expected = brute_force(self.sequences, set())
+        result = snpdistance.snp_distances(self.sequences)
+        self.assertEqual(result.tolist(), expected.tolist())
+
+    def test_snp_distances_cutoff_processes(self):
+        matrix = brute_force(self.sequences, self.masked_positions)
+        expected = [(i, j, int(matrix[i, j])) for i in range(12) for j in range(i + 1, 12) if matrix[i, j] <= 10]
+        result = snpdistance.snp_distances(self.sequences, self.mask, cutoff=10, processes=2, block_rows=3)
+        self.assertEqual(result, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
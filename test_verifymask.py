@@ -0,0 +1,98 @@
+# Test verifymask.py
+# Run all tests: python3 test_verifymask.py
+# Run code coverage: coverage run test_verifymask.py
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import applymask
+import verifymask
+
+class TestVerifyMask(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.mask = applymask.load_mask("data/mask_range_contig.tsv", "range")
+        self.source_filepath = os.path.join(self.dirpath, "multi.fasta")
+        shutil.copy("data/test_multi.fasta", self.source_filepath)
+        self.records = applymask.load_fasta_records(self.source_filepath)
+        self.masked_records = [(header, applymask.apply_mask(self.mask[header[1:9]], sequence) if header[1:9] in self.mask else sequence, chunk_len)
+                               for header, sequence, chunk_len in self.records]
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    # masked copy of the source, chunk_len may differ from the source wrapping
+    def save_masked(self, records, filename="multi.masked.fasta", chunk_len=None):
+        masked_filepath = os.path.join(self.dirpath, filename)
+        records = [(header, sequence, chunk_len or record_chunk_len) for header, sequence, record_chunk_len in records]
+        applymask.save_fasta_records(masked_filepath, records, use_gzip=masked_filepath.endswith(".gz"))
+        return masked_filepath
+
+    def test_sequence_reader(self):
+        reader = verifymask.FastaSequenceReader(io.BytesIO(b">a\nACG\nTA\n>b x\nGG\n>c\n"))
+        self.assertEqual(reader.next_record(), ">a")
+        self.assertEqual(reader.read(4), b"ACGT")
+        self.assertEqual(reader.read(4), b"A")
+        self.assertEqual(reader.read(4), b"")
+        self.assertEqual(reader.next_record(), ">b x")
+        self.assertEqual(reader.read(1), b"G")
+        self.assertEqual(reader.next_record(), ">c")
+        self.assertEqual(reader.read(1), b"")
+        self.assertIsNone(reader.next_record())
+
+    def test_verify_fasta(self):
+        # small chunks and a different line wrapping than the source
+        masked_filepath = self.save_masked(self.masked_records, "multi.fasta.masked.gz", chunk_len=7)
+        summary = verifymask.verify_fasta(self.mask, self.source_filepath, masked_filepath, chunk_size=3)
+        self.assertTrue(summary["ok"])
+        self.assertEqual((summary["records"], summary["bases"], summary["masked_bases"]), (3, 50, 5))
+
+    def test_verify_fasta_mismatches(self):
+        records = list(self.masked_records)
+        header, sequence, chunk_len = records[0]
+        # an unmasked N and a masked base left in place
+        records[0] = (header, "A" + sequence[1:5] + "N" + sequence[6:], chunk_len)
+        masked_filepath = self.save_masked(records)
+        summary = verifymask.verify_fasta(self.mask, self.source_filepath, masked_filepath, chunk_size=4)
+        self.assertFalse(summary["ok"])
+        self.assertEqual((summary["not_masked"], summary["changed"]), (1, 1))
+        self.assertEqual(summary["mismatches"], [(">contig_1 first", 0, "A", "A"), (">contig_1 first", 5, "A", "N")])
+
+        summary = verifymask.verify_fasta(self.mask, self.source_filepath, masked_filepath, chunk_size=4, stop_at_first=True)
+        self.assertEqual((summary["not_masked"], summary["changed"], summary["records"]), (1, 0, 1))
+
+    def test_verify_fasta_structure(self):
+        masked_filepath = self.save_masked(self.masked_records[:2] + [(">contig_3", "ACGTACGTA", 10)])
+        summary = verifymask.verify_fasta(self.mask, self.source_filepath, masked_filepath)
+        self.assertFalse(summary["ok"])
+        self.assertEqual(len(summary["errors"]), 1)
+
+        masked_filepath = self.save_masked(self.masked_records[:2])
+        summary = verifymask.verify_fasta(self.mask, self.source_filepath, masked_filepath)
+        self.assertRegex(summary["errors"][0], "record 3 is >contig_3")
+
+    def test_source_fasta_filepath(self):
+        masked_filepath = self.save_masked(self.masked_records)
+        self.assertEqual(verifymask.source_fasta_filepath(masked_filepath), self.source_filepath)
+        applymask.write_manifest(masked_filepath, None, "data/test_multi.fasta")
+        self.assertEqual(verifymask.source_fasta_filepath(masked_filepath), os.path.abspath("data/test_multi.fasta"))
+        self.assertIsNone(verifymask.source_fasta_filepath(os.path.join(self.dirpath, "other.fasta.masked.gz")))
+
+    def test_verify_directory(self):
+        masked_dirpath = os.path.join(self.dirpath, "masked")
+        os.mkdir(masked_dirpath)
+        applymask.save_fasta_records(os.path.join(self.dirpath, "multi.fasta.gz"), self.records, use_gzip=True)
+        self.save_masked(self.masked_records, "masked/multi.masked.fasta")
+        self.save_masked(self.records, "masked/multi.fasta.masked.gz")
+        self.save_masked(self.records, "masked/orphan.masked.fasta")
+        summaries = verifymask.verify_directory(self.mask, masked_dirpath, self.dirpath, processes=2)
+        self.assertEqual([os.path.basename(summary["masked"]) for summary in summaries],
+                         ["multi.fasta.masked.gz", "multi.masked.fasta", "orphan.masked.fasta"])
+        self.assertEqual([summary["ok"] for summary in summaries], [False, True, False])
+        self.assertEqual(summaries[0]["not_masked"], 5)
+        self.assertEqual(summaries[2]["errors"], ["no source fasta found"])
+
+if __name__ == '__main__':
+    unittest.main()
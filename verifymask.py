@@ -0,0 +1,219 @@
+#! /usr/bin/env python3
+
+# verify masked fastas against their source and the mask
+# masked positions must be N and every other base identical to the source
+# source and masked fasta are streamed side by side in chunks of bases,
+# whatever their line wrapping, and compared with vectorized checks
+# python3 verifymask.py tb/TB-exclude.txt position sample.fasta.masked.gz sample.fasta.gz
+# python3 verifymask.py tb/TB-exclude.txt position masked/ --dir --source-dir samples/ --processes 8
+import os
+import sys
+import glob
+import argparse
+import multiprocessing
+
+import numpy as np
+
+import applymask
+
+# reads the sequence of a fasta record by record, in chunks of bases
+class FastaSequenceReader:
+    def __init__(self, f):
+        self.lines = iter(f)
+        self.next_header = None
+        self.buffer = bytearray()
+
+    # header of the next record, None at the end of the file
+    # the rest of the current record is skipped
+    def next_record(self):
+        while self.next_header is None:
+            line = next(self.lines, None)
+            if line is None:
+                return None
+            if line.startswith(b'>'):
+                self.next_header = line
+        header = self.next_header.decode().strip()
+        self.next_header = None
+        self.buffer.clear()
+        return header
+
+    # up to n bases of the current record, b'' at its end
+    def read(self, n):
+        while len(self.buffer) < n and self.next_header is None:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            if line.startswith(b'>'):
+                self.next_header = line
+                break
+            self.buffer += line.rstrip(b'\r\n')
+        chunk = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return chunk
+
+def new_summary(source_filepath, masked_filepath):
+    return {
+        "source": source_filepath,
+        "masked": masked_filepath,
+        "records": 0,
+        "bases": 0,
+        "masked_bases": 0,
+        # masked positions that aren't N
+        "not_masked": 0,
+        # unmasked positions that differ from the source
+        "changed": 0,
+        # [(header, position, source base, masked base)] of the first mismatches
+        "mismatches": list(),
+        "errors": list(),
+    }
+
+# returns the summary dict, summary["ok"] is True when the masked fasta matches
+# stop_at_first stops at the first chunk with a mismatch
+def verify_fasta(mask, source_filepath, masked_filepath, chunk_size=1 << 20, stop_at_first=False, max_mismatches=10):
+    summary = new_summary(source_filepath, masked_filepath)
+    with applymask.open_fasta(source_filepath, "rb", source_filepath.endswith(".gz")) as f_source, \
+         applymask.open_fasta(masked_filepath, "rb", masked_filepath.endswith(".gz")) as f_masked:
+        source_reader, masked_reader = FastaSequenceReader(f_source), FastaSequenceReader(f_masked)
+        while not (stop_at_first and (summary["not_masked"] or summary["changed"])):
+            header, masked_header = source_reader.next_record(), masked_reader.next_record()
+            if header is None and masked_header is None:
+                break
+            if header != masked_header:
+                summary["errors"].append(f"record {summary['records'] + 1} is {header} in the source and {masked_header} in the masked fasta")
+                break
+            summary["records"] += 1
+            if not verify_record(applymask.mask_for_record(mask, header), header, source_reader, masked_reader, summary, chunk_size, stop_at_first, max_mismatches):
+                break
+    summary["ok"] = not (summary["errors"] or summary["not_masked"] or summary["changed"])
+    return summary
+
+# False when the comparison can't go on
+def verify_record(record_mask, header, source_reader, masked_reader, summary, chunk_size, stop_at_first, max_mismatches):
+    offset = 0
+    while True:
+        bases = source_reader.read(chunk_size)
+        masked_bases = masked_reader.read(len(bases) or 1)
+        if len(masked_bases) != len(bases):
+            summary["errors"].append(f"{header} has length {offset + len(bases)} in the source and more or fewer bases in the masked fasta")
+            return False
+        if not bases:
+            return True
+        source_arr = np.frombuffer(bases, dtype=np.uint8)
+        masked_arr = np.frombuffer(masked_bases, dtype=np.uint8)
+        window = np.zeros(len(bases), dtype=bool) if record_mask is None else record_mask.window(offset, offset + len(bases))
+        mismatches = np.flatnonzero(np.where(window, masked_arr != ord('N'), masked_arr != source_arr))
+        summary["bases"] += len(bases)
+        summary["masked_bases"] += int(np.count_nonzero(window))
+        if len(mismatches):
+            not_masked = int(np.count_nonzero(window[mismatches]))
+            summary["not_masked"] += not_masked
+            summary["changed"] += len(mismatches) - not_masked
+            for i in mismatches[:max(0, max_mismatches - len(summary["mismatches"]))].tolist():
+                summary["mismatches"].append((header, offset + i, chr(source_arr[i]), chr(masked_arr[i])))
+            if stop_at_first:
+                return False
+        offset += len(bases)
+
+def print_summary(summary):
+    status = "ok" if summary["ok"] else "FAILED"
+    print(f"{summary['masked']}\t{status}\t{summary['records']} records\t{summary['bases']} bases\t"
+          f"{summary['masked_bases']} masked\t{summary['not_masked']} masked bases not N\t{summary['changed']} unmasked bases changed")
+    for header, position, source_base, masked_base in summary["mismatches"]:
+        print(f"  {header}\t{position}\tsource {source_base}\tmasked {masked_base}")
+    for error in summary["errors"]:
+        print(f"  {error}")
+
+# the source a masked fasta was made from, from its manifest, or else in
+# source_dirpath by reversing applymask.masked_fasta_filepath
+# x.fasta.gz -> x.fasta.masked.gz, x.fasta -> x.masked.fasta
+def source_fasta_filepath(masked_filepath, source_dirpath=None):
+    try:
+        source_filepath = applymask.read_manifest(masked_filepath)["source"]
+        if os.path.exists(source_filepath):
+            return source_filepath
+    except FileNotFoundError:
+        pass
+    source_dirpath = source_dirpath or os.path.dirname(masked_filepath)
+    filename = os.path.basename(masked_filepath)
+    if filename.endswith(".masked.gz"):
+        candidates = [os.path.join(source_dirpath, filename[:-len(".masked.gz")] + ".gz")]
+    else:
+        stem = filename[:-len(".masked.fasta")]
+        candidates = [os.path.join(source_dirpath, stem + extension) for extension in (".fasta", ".fa", ".fna", ".fas")]
+        candidates += sorted(glob.glob(os.path.join(glob.escape(source_dirpath), glob.escape(stem) + ".*")))
+    for candidate in candidates:
+        if os.path.exists(candidate) and not candidate.endswith(".masked.fasta"):
+            return candidate
+    return None
+
+# worker process state, the mask is sent once per worker
+_worker_mask = None
+
+def _init_worker(mask):
+    global _worker_mask
+    _worker_mask = mask
+
+def _verify_worker(job):
+    source_filepath, masked_filepath, options = job
+    try:
+        return verify_fasta(_worker_mask, source_filepath, masked_filepath, **options)
+    except Exception as e:
+        summary = new_summary(source_filepath, masked_filepath)
+        summary["errors"].append(f"{type(e).__name__}: {e}")
+        summary["ok"] = False
+        return summary
+
+# verify every *.masked.gz and *.masked.fasta of masked_dirpath on a process pool
+# options are passed on to verify_fasta
+# returns the summaries in file order
+def verify_directory(mask, masked_dirpath, source_dirpath=None, processes=None, **options):
+    masked_filepaths = sorted(glob.glob(os.path.join(glob.escape(masked_dirpath), "*.masked.gz"))
+                              + glob.glob(os.path.join(glob.escape(masked_dirpath), "*.masked.fasta")))
+    summaries, jobs = dict(), list()
+    for masked_filepath in masked_filepaths:
+        source_filepath = source_fasta_filepath(masked_filepath, source_dirpath)
+        if source_filepath is None:
+            summaries[masked_filepath] = new_summary(None, masked_filepath)
+            summaries[masked_filepath]["errors"].append("no source fasta found")
+            summaries[masked_filepath]["ok"] = False
+        else:
+            jobs.append((source_filepath, masked_filepath, options))
+    if jobs:
+        with multiprocessing.Pool(processes or applymask.available_cores(), _init_worker, (mask,)) as pool:
+            for summary in pool.imap_unordered(_verify_worker, jobs):
+                summaries[summary["masked"]] = summary
+    return [summaries[masked_filepath] for masked_filepath in masked_filepaths]
+
+def main(mask_filepath, mask_format, masked_filepath, source_filepath=None, directory=False, source_dirpath=None, processes=None, cache=False, **options):
+    mask = (applymask.load_mask_cached if cache else applymask.load_mask)(mask_filepath, mask_format)
+    if mask is None:
+        return None
+    if directory:
+        summaries = verify_directory(mask, masked_filepath, source_dirpath, processes, **options)
+    else:
+        source_filepath = source_filepath or source_fasta_filepath(masked_filepath, source_dirpath)
+        if source_filepath is None:
+            raise ValueError(f"no source fasta found for {masked_filepath}")
+        summaries = [verify_fasta(mask, source_filepath, masked_filepath, **options)]
+    for summary in summaries:
+        print_summary(summary)
+    failures = sum(1 for summary in summaries if not summary["ok"])
+    print(f"{len(summaries) - failures} of {len(summaries)} masked fastas verified")
+    return summaries
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("mask_filepath")
+    p.add_argument("mask_format", help="fasta, position, range or bed")
+    p.add_argument("masked_filepath", help="masked fasta, or directory of masked fastas with --dir")
+    p.add_argument("source_filepath", nargs="?", help="unmasked fasta, defaults to the manifest's source or a matching file in --source-dir")
+    p.add_argument("--dir", action="store_true", help="verify every *.masked.gz and *.masked.fasta of the directory in parallel")
+    p.add_argument("--source-dir", help="directory of the unmasked fastas, defaults to the masked fasta's directory")
+    p.add_argument("--processes", type=int, help="worker processes with --dir, defaults to the available cores")
+    p.add_argument("--cache", action="store_true", help="reuse the compiled mask from the on-disk cache")
+    p.add_argument("--first", action="store_true", help="stop each file at its first mismatch")
+    p.add_argument("--chunk-size", type=int, default=1 << 20, help="bases compared at a time, default 1 MiB")
+    args = p.parse_args()
+    summaries = main(args.mask_filepath, args.mask_format, args.masked_filepath, args.source_filepath, args.dir, args.source_dir,
+                     args.processes, args.cache, chunk_size=args.chunk_size, stop_at_first=args.first)
+    sys.exit(0 if summaries and all(summary["ok"] for summary in summaries) else 1)